@@ -0,0 +1,48 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import pytest
+
+from testing import Path, run, venv_update
+
+
+def pip_freeze(venv):
+    out, err = run('%s/bin/python' % venv, '%s/bin/pip' % venv, 'freeze', '--local')
+    assert err == ''
+    return out
+
+
+def test_batch(tmpdir):
+    tmpdir.chdir()
+
+    # arbitrary small packages: pep8, mccabe
+    Path('a').mkdir()
+    Path('a/requirements.txt').write('pep8==1.5.7\nmccabe==0.3\n')
+    Path('b').mkdir()
+    Path('b/requirements.txt').write('pep8==1.5.7\n')
+    Path('manifest.txt').write('''\
+a/virtualenv_run a/requirements.txt
+b/virtualenv_run b/requirements.txt
+''')
+
+    out, err = venv_update('--batch=manifest.txt', '--jobs=2')
+    assert err == ''
+    # pep8 is shared, so it is only fetched (and, from an sdist, built) once
+    assert out.count('Downloading pep8-1.5.7') == 1
+
+    assert pip_freeze('a/virtualenv_run') == 'argparse==1.2.1\nmccabe==0.3\npep8==1.5.7\nwheel==0.24.0\n'
+    assert pip_freeze('b/virtualenv_run') == 'argparse==1.2.1\npep8==1.5.7\nwheel==0.24.0\n'
+
+    # each virtualenv was updated under its own lock, as a venv-update of its own would be
+    assert Path('a/virtualenv_run/.venv-update/last-update.json').exists()
+    assert Path('b/virtualenv_run/.venv-update/last-update.json').exists()
+
+
+def test_batch_transactional(tmpdir):
+    tmpdir.chdir()
+    Path('manifest.txt').write('virtualenv_run requirements.txt\n')
+    from subprocess import CalledProcessError
+    with pytest.raises(CalledProcessError) as excinfo:
+        venv_update('--batch=manifest.txt', '--transactional')
+    _, err = excinfo.value.result
+    assert "--transactional can't be combined with --batch" in err
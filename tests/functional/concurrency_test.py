@@ -0,0 +1,52 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from testing import Path, requirements
+
+
+def venv_update_concurrently(*argvs):
+    """Start several venv-updates at once, and wait for them all. Returns their (exit code, output)."""
+    from os import environ
+    from subprocess import Popen, PIPE, STDOUT
+    env = dict(environ, HOME=str(Path('.').realpath()))
+    processes = [
+        Popen(('venv-update',) + argv, stdout=PIPE, stderr=STDOUT, env=env)
+        for argv in argvs
+    ]
+    results = []
+    for process in processes:
+        out = process.communicate()[0].decode('UTF-8')
+        results.append((process.returncode, out))
+    return results
+
+
+def test_concurrent_builds_are_shared(tmpdir):
+    tmpdir.chdir()
+    # An arbitrary small package: pep8
+    requirements('pep8==1.5.7')
+
+    results = venv_update_concurrently(('a',), ('b',))
+    assert [returncode for returncode, out in results] == [0, 0]
+
+    # only one of them fetched (and, from an sdist, would have built) the wheel; the other waited for it
+    out = ''.join(out for returncode, out in results)
+    assert out.count('Downloading pep8-1.5.7') == 1
+    wheels = Path('.pip/wheelhouse').listdir('pep8-*.whl')
+    assert len(wheels) == 1
+    # nothing half-written is left behind
+    wheelhouse = Path('.pip/wheelhouse')
+    assert wheelhouse.listdir('.build-*') + wheelhouse.listdir('.tmp-*') + wheelhouse.join('.index').listdir('.*') == []
+
+
+def test_concurrent_updates_coalesce(tmpdir):
+    tmpdir.chdir()
+    # An arbitrary small package: pep8
+    requirements('pep8==1.5.7')
+
+    results = venv_update_concurrently((), ())
+    assert [returncode for returncode, out in results] == [0, 0]
+
+    # the second waited for the first, then saw there was nothing left to do
+    out = ''.join(out for returncode, out in results)
+    assert out.count('A concurrent venv-update just finished the same update of virtualenv_run') == 1
+    assert len([line for line in out.splitlines() if line.endswith(' -m virtualenv virtualenv_run')]) == 1
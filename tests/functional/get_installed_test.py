@@ -1,7 +1,7 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
-from testing import run, venv_update_script
+from testing import Path, run, venv_update_script
 
 
 def get_installed():
@@ -38,3 +38,27 @@ def test_pip_get_installed(tmpdir):
 
     run('myvenv/bin/pip', 'uninstall', '--yes', 'flake8')
     assert get_installed() == ['argparse', 'mccabe', 'pep8', 'pip', 'pyflakes', 'setuptools']
+
+
+def test_installed_index(tmpdir):
+    tmpdir.chdir()
+
+    run('virtualenv', 'myvenv')
+    run('rm', '-rf', 'myvenv/local')
+    assert get_installed() == ['pip', 'setuptools']
+
+    index = Path('myvenv/.venv-update/installed.json')
+    assert index.check(file=True)
+
+    # the index is reused, as long as nothing is installed
+    mtime = index.mtime()
+    assert get_installed() == ['pip', 'setuptools']
+    assert index.mtime() == mtime
+
+    # it notices changes made behind its back
+    run('myvenv/bin/pip', 'install', 'pep8')
+    assert get_installed() == ['pep8', 'pip', 'setuptools']
+    assert index.mtime() != mtime
+
+    run('myvenv/bin/pip', 'uninstall', '--yes', 'pep8')
+    assert get_installed() == ['pip', 'setuptools']
@@ -14,6 +14,7 @@ from testing import (
 )
 
 from sys import version_info
+PY27 = (version_info[:2] == (2, 7))
 PY33 = (version_info >= (3, 3))
 
 
@@ -188,6 +189,42 @@ for p in sys.path:
     assert out and Path(out).isdir()
 
 
+def test_arguments_system_packages_in_place(tmpdir):
+    """Switching --system-site-packages doesn't need a whole new virtualenv"""
+    tmpdir.chdir()
+    requirements('')
+
+    venv_update()
+    marker = Path('virtualenv_run/bin/marker')
+    marker.write('')
+
+    venv_update('--system-site-packages')
+    assert marker.exists()
+    assert not list(Path('virtualenv_run/lib').visit('no-global-site-packages.txt'))
+
+    venv_update()
+    assert marker.exists()
+    assert list(Path('virtualenv_run/lib').visit('no-global-site-packages.txt'))
+
+
+def test_arguments_python_changed(tmpdir):
+    """A different interpreter means starting over"""
+    tmpdir.chdir()
+    requirements('')
+
+    python_arg = '--python=python' + ('2.6' if PY27 else '2.7')
+
+    venv_update()
+    marker = Path('virtualenv_run/bin/marker')
+    marker.write('')
+
+    venv_update()
+    assert marker.exists()
+
+    venv_update(python_arg)
+    assert not marker.exists()
+
+
 def pip(*args):
     # because the scripts are made relative, it won't use the venv python without being explicit.
     return run('virtualenv_run/bin/python', 'virtualenv_run/bin/pip', *args)
@@ -271,6 +308,358 @@ def assert_timestamps(*reqs):
     assert Path(reqs[0]).mtime() < Path('virtualenv_run').mtime()
 
 
+def test_transactional(tmpdir):
+    tmpdir.chdir()
+    # An arbitrary small package: mccabe
+    requirements('mccabe')
+
+    venv_update('--transactional')
+    assert 'mccabe' in pip_freeze()
+    venv_mtime = Path('virtualenv_run').mtime()
+    # the new virtualenv was made off to the side, but knows itself by its own name
+    out, _ = run('sh', '-c', '. virtualenv_run/bin/activate && echo "$VIRTUAL_ENV"')
+    assert out == Path('virtualenv_run').realpath().strpath + '\n'
+    assert '.shadow' not in Path('virtualenv_run/.venv-update/installed.json').read()
+
+    # garbage, to cause a failure
+    requirements('pep8\n-w wat')
+
+    from subprocess import CalledProcessError
+    with pytest.raises(CalledProcessError) as excinfo:
+        venv_update('--transactional')
+
+    assert excinfo.value.returncode == 1
+    out, _ = excinfo.value.result
+    # the original virtualenv is untouched: not updated, nor sent back in time
+    assert 'mccabe' in pip_freeze()
+    assert 'pep8' not in pip_freeze()
+    assert Path('virtualenv_run').mtime() == venv_mtime
+    assert sorted(path.basename for path in Path('.').listdir()) == [
+        '.pip', 'requirements.txt', 'virtualenv_run',
+    ]
+
+    requirements('pep8')
+    venv_update('--transactional')
+    assert 'pep8' in pip_freeze()
+    assert 'mccabe' not in pip_freeze()
+    assert Path('requirements.txt').mtime() < Path('virtualenv_run').mtime()
+
+
+def test_events(tmpdir):
+    import json
+    tmpdir.chdir()
+    # An arbitrary small package: mccabe
+    requirements('mccabe')
+
+    venv_update('--events=events.jsonl')
+    events = [json.loads(line) for line in Path('events.jsonl').readlines()]
+
+    phases = [event['phase'] for event in events if event['event'] == 'phase-end']
+    assert phases == ['virtualenv', 'drift', 'bootstrap', 'wheel', 'install', 'trace', 'stage2', 'relocatable', 'stage1']
+    # both stages write to the same stream
+    assert len(set(event['pid'] for event in events)) == 2
+
+    installs = dict((event['name'], event) for event in events if event['event'] == 'install')
+    assert installs['mccabe']['success'] is True
+    assert installs['mccabe']['bytes'] > 0
+    assert installs['mccabe']['seconds'] > 0
+
+
+def test_single_process(tmpdir):
+    import json
+    tmpdir.chdir()
+    # An arbitrary small package, with a script: pep8
+    requirements('pep8==1.5.7')
+
+    out, _ = venv_update('--single-process', '--events=events.jsonl')
+    out = uncolor(out)
+    # virtualenv runs within venv-update, rather than as a separate python
+    assert '> virtualenv virtualenv_run\n' in out
+    assert ' -m virtualenv ' not in out
+    assert '> virtualenv --relocatable virtualenv_run\n' in out
+    assert Path('virtualenv_run/bin/pep8').read().startswith('#!/usr/bin/env python')
+
+    events = [json.loads(line) for line in Path('events.jsonl').readlines()]
+    phases = [event['phase'] for event in events if event['event'] == 'phase-end']
+    assert phases == ['virtualenv', 'drift', 'bootstrap', 'wheel', 'install', 'trace', 'stage2', 'relocatable']
+    # stage2 replaced stage1, rather than running as its child
+    assert len(set(event['pid'] for event in events)) == 1
+
+    # and the record of the update is still kept, for any concurrent update
+    assert Path('virtualenv_run/.venv-update/last-update.json').exists()
+
+
+def test_single_process_transactional(tmpdir):
+    tmpdir.chdir()
+    requirements('')
+    from subprocess import CalledProcessError
+    with pytest.raises(CalledProcessError) as excinfo:
+        venv_update('--single-process', '--transactional')
+    _, err = excinfo.value.result
+    assert "--single-process can't be combined with --batch or --transactional" in err
+
+
+def test_skeleton(tmpdir):
+    tmpdir.chdir()
+    # An arbitrary small package, with a script: pep8
+    requirements('pep8==1.5.7')
+
+    out, _ = venv_update('--skeleton')
+    assert 'Cloning a cached virtualenv: ' in out
+    skeletons = Path('.pip/venv-update/skeletons').listdir('*.json')
+    assert len(skeletons) == 1
+    assert not Path('virtualenv_run/bin/activate').read().count(skeletons[0].purebasename)
+    assert 'pep8' in pip_freeze()
+
+    # the next virtualenv is a copy; virtualenv doesn't create it (though it does still make it --relocatable)
+    Path('virtualenv_run').remove()
+    out, _ = venv_update('--skeleton')
+    assert not [line for line in uncolor(out).splitlines() if line.endswith(' -m virtualenv virtualenv_run')]
+    assert 'Cloning a cached virtualenv: ' in out
+    assert Path('virtualenv_run/bin/activate').read().count(Path('virtualenv_run').strpath)
+    assert 'pep8' in pip_freeze()
+
+
+def test_cache_counters(tmpdir):
+    tmpdir.chdir()
+    # An arbitrary small package: mccabe
+    requirements('mccabe==0.3')
+    out, _ = venv_update()
+    assert '  fast-path miss (not in wheelhouse): ' in uncolor(out)
+
+    requirements('mccabe==0.3\npep8==1.5.7')
+    out, _ = venv_update()
+    assert '  fast-path hit (installed): ' in uncolor(out)
+
+    requirements('mccabe')
+    out, _ = venv_update()
+    assert '  fast-path miss (unpinned): ' in uncolor(out)
+
+
+def test_collapse_cache(tmpdir):
+    tmpdir.chdir()
+
+    def downloads(name):
+        return [path for path in Path('.pip/cache').listdir() if '%2F' + name in path.basename]
+
+    # An arbitrary small package: mccabe, which is downloaded as a wheel
+    requirements('mccabe==0.3')
+    venv_update()
+    assert downloads('mccabe-0.3')
+
+    out, _ = venv_update('--collapse-cache')
+    assert ' from the download cache, since they have wheels.' in out
+    assert not downloads('mccabe-0.3')
+    assert Path('.pip/wheelhouse').listdir('mccabe-0.3-*.whl')
+    # argparse is an sdist, whose wheel is for python2 only: a python3 would still need to build from it
+    assert Path('.pip/wheelhouse').listdir('argparse-1.2.1-py2-none-any.whl')
+    assert downloads('argparse-1.2.1.tar.gz')
+
+    # nothing is downloaded again, since the wheel is what gets installed
+    Path('virtualenv_run').remove()
+    out, _ = venv_update('--collapse-cache')
+    assert ' from the download cache, since they have wheels.' not in out
+    assert not downloads('mccabe-0.3')
+
+
+def test_wheel_verified(tmpdir):
+    tmpdir.chdir()
+    # An arbitrary small package: mccabe
+    requirements('mccabe==0.3')
+    venv_update()
+    wheel, = Path('.pip/wheelhouse').listdir('mccabe-0.3-*.whl')
+    assert Path('.pip/wheelhouse/.index').join(wheel.basename + '.json').check()
+
+    # a wheel that's changed since it was built is refused
+    wheel.write_binary(wheel.read_binary() + b'tampered')
+    Path('virtualenv_run').remove()
+    from subprocess import CalledProcessError
+    with pytest.raises(CalledProcessError) as excinfo:
+        venv_update()
+    out, err = excinfo.value.result
+    assert ' has changed since it was added to the wheelhouse' in out + err
+
+    # without it, it's simply built again
+    wheel.remove()
+    venv_update()
+    assert 'mccabe' in pip_freeze()
+
+
+def test_warm_cache(tmpdir):
+    import json
+    tmpdir.chdir()
+    # Arbitrary small packages: mccabe, pep8
+    Path('a.txt').write('mccabe==0.3\n')
+    Path('b.txt').write('pep8==1.5.7\nmccabe==0.3\n')
+
+    out, _ = venv_update('--warm-cache', '--events=events.jsonl', 'a.txt', 'b.txt')
+    # the builds go through our pip, and so share the wheelhouse safely
+    assert '--wheel-worker=' in out
+    assert 'pip.__main__' not in out
+    # each worker reports its own cache counters
+    assert '  fast-path miss (not in wheelhouse): ' in uncolor(out)
+    events = [json.loads(line) for line in Path('events.jsonl').readlines()]
+    assert [event for event in events if event['event'] == 'cache-counters']
+    wheels = sorted(path.basename.split('-')[0] for path in Path('.pip/wheelhouse').listdir('*.whl'))
+    assert wheels == ['argparse', 'mccabe', 'pep8', 'wheel']
+    # no virtualenv
+    assert not Path('virtualenv_run').exists()
+
+    # the second time, there's nothing to build
+    out, _ = venv_update('--warm-cache', 'a.txt', 'b.txt')
+    assert '--wheel-worker=' not in out
+
+    # a requirement's own requirements are checked too
+    Path('c.txt').write('flake8==2.2.3\n')
+    venv_update('--warm-cache', 'c.txt')
+    pyflakes, = Path('.pip/wheelhouse').listdir('pyflakes-*.whl')
+    pyflakes.remove()
+    out, _ = venv_update('--warm-cache', 'c.txt')
+    assert '--wheel-worker=' in out
+    assert pyflakes.exists()
+
+
+@pytest.mark.parametrize('mode, compiled', [
+    ('parallel', True),
+    ('new', True),
+    ('lazy', False),
+])
+def test_compile(tmpdir, mode, compiled):
+    tmpdir.chdir()
+    # An arbitrary small package: mccabe
+    requirements('mccabe==0.3')
+    venv_update('--compile=' + mode)
+
+    bytecode = list(Path('virtualenv_run').visit('mccabe*.py[co]'))
+    assert bool(bytecode) is compiled
+    assert 'mccabe' in pip_freeze()
+
+
+def test_compile_bad_mode(tmpdir):
+    tmpdir.chdir()
+    requirements('')
+    from subprocess import CalledProcessError
+    with pytest.raises(CalledProcessError) as excinfo:
+        venv_update('--compile=sometimes')
+    _, err = excinfo.value.result
+    assert '--compile must be one of: parallel, new, lazy' in err
+
+
+def test_plan(tmpdir):
+    import json
+    tmpdir.chdir()
+    # Arbitrary small packages: mccabe, pep8
+    requirements('mccabe==0.2.1\npep8==1.5.7')
+    venv_update()
+
+    requirements('mccabe==0.3')
+    venv_update('--warm-cache')
+    mtime = Path('virtualenv_run').mtime()
+
+    out, _ = venv_update('--plan')
+    assert json.loads(out) == {
+        'install': [],
+        'upgrade': [{'name': 'mccabe', 'from': '0.2.1', 'to': '0.3'}],
+        'downgrade': [],
+        'remove': [{'name': 'pep8', 'version': '1.5.7'}],
+        'unresolved': [],
+    }
+    # nothing changed
+    assert 'pep8' in pip_freeze()
+    assert Path('virtualenv_run').mtime() == mtime
+
+    requirements('mccabe==0.3\npytest==2.6.4')
+    venv_update('--plan=plan.json')
+    plan = json.loads(Path('plan.json').read())
+    assert plan['install'] == [{'name': 'pytest', 'version': '2.6.4'}]
+    assert [description.split()[0] for description in plan['unresolved']] == ['pytest==2.6.4']
+
+    # a pin which no wheel satisfies is shown at its own version, not at the version of some wheel we have
+    requirements('mccabe==0.2')
+    out, _ = venv_update('--plan')
+    plan = json.loads(out)
+    assert plan['downgrade'] == [{'name': 'mccabe', 'from': '0.2.1', 'to': '0.2'}]
+    assert [description.split()[0] for description in plan['unresolved']] == ['mccabe==0.2']
+
+
+def test_plan_no_virtualenv(tmpdir):
+    import json
+    tmpdir.chdir()
+    requirements('mccabe==0.3')
+    out, _ = venv_update('--plan')
+    assert json.loads(out)['install'] == [
+        {'name': 'argparse', 'version': '1.2.1'},
+        {'name': 'mccabe', 'version': '0.3'},
+        {'name': 'wheel', 'version': '0.24.0'},
+    ]
+    assert not Path('virtualenv_run').exists()
+
+
+def test_drift(tmpdir):
+    tmpdir.chdir()
+    # Arbitrary small packages, one with a script (which --relocatable rewrites): pep8, mccabe
+    requirements('pep8==1.5.7')
+    venv_update()
+
+    # nothing changed: nothing to do
+    out, _ = venv_update()
+    assert 'Nothing has changed since the last update.' in out
+    assert '> pip ' not in uncolor(out)
+
+    # someone changed a file, and installed something extra, by hand
+    pep8 = list(Path('virtualenv_run').visit('pep8.py'))[0]
+    pep8.write('garbage')
+    pip('install', 'mccabe==0.3')
+
+    out, _ = venv_update()
+    out = uncolor(out)
+    assert '--force-reinstall pep8==1.5.7' in out
+    assert '> pip uninstall --yes mccabe' in out
+    assert pep8.read() != 'garbage'
+    assert 'mccabe' not in pip_freeze()
+
+    # the reinstalled script is made relocatable again, and noted as such
+    out, _ = venv_update()
+    assert 'Nothing has changed since the last update.' in out
+    assert '--force-reinstall' not in out
+
+    # an unpinned requirement always gets the full update
+    requirements('pep8')
+    out, _ = venv_update()
+    assert 'Nothing has changed since the last update.' not in out
+    assert '> pip wheel' in uncolor(out)
+
+
+def test_drift_transactional(tmpdir):
+    tmpdir.chdir()
+    # An arbitrary small package: mccabe
+    requirements('mccabe==0.3')
+    venv_update('--transactional')
+
+    # the manifest was made in the shadow virtualenv, but still holds once it's swapped into place
+    out, _ = venv_update('--transactional')
+    assert 'Nothing has changed since the last update.' in out
+    assert '--force-reinstall' not in out
+
+
+def test_warm_cache_interpreters(tmpdir):
+    tmpdir.chdir()
+    # An arbitrary small package, and one with a c extension: mccabe, simplejson
+    requirements('mccabe==0.3\nsimplejson==3.6.5')
+
+    venv_update('--warm-cache', '--interpreters=python')
+    wheels = sorted(path.basename.split('-')[0] for path in Path('.pip/wheelhouse').listdir('*.whl'))
+    assert wheels == ['argparse', 'mccabe', 'simplejson', 'wheel']
+    assert not Path('virtualenv_run').exists()
+
+    # the builder virtualenv is kept, for next time
+    builders = Path('.pip/venv-update/builders').listdir(lambda path: path.isdir())
+    assert len(builders) == 1
+    out, _ = venv_update('--warm-cache', '--interpreters=python')
+    assert '-m virtualenv' not in out
+    assert Path('.pip/venv-update/builders').listdir(lambda path: path.isdir()) == builders
+
+
 def test_timestamps_single(tmpdir):
     tmpdir.chdir()
     requirements('')
@@ -62,6 +62,17 @@ def test_pip_get_installed():
     assert 'venv-update' in venv_update.reqnames(installed)
 
 
+def test_installed_dist():
+    record = venv_update.InstalledDist.from_index({
+        'name': 'venv-update', 'version': '0.1', 'location': '/src', 'requires': ['pip'], 'editable': True,
+    })
+    assert (record.name, record.version, record.location, record.editable) == ('venv-update', '0.1', '/src', True)
+    assert repr(record) == '<InstalledDist venv-update==0.1 (editable)>'
+    assert venv_update.reqnames([record]) == set(['venv-update'])
+    # compact: no per-record dict
+    assert not hasattr(record, '__dict__')
+
+
 @pytest.mark.parametrize('filename,expected', [
     ('foo.py', 'foo.py'),
     ('foo.pyc', 'foo.py'),
@@ -255,3 +266,1188 @@ def test_wait_for_all_subprocesses(monkeypatch):
 
     assert _nonlocal.wait == 0
     assert _nonlocal.thrown is True
+
+
+@pytest.mark.parametrize('args,expected', [
+    (
+        (),
+        ({}, ()),
+    ), (
+        ('a', '--python=python3', 'b'),
+        ({}, ('a', '--python=python3', 'b')),
+    ), (
+        ('--batch=manifest.txt', '--jobs=3', '--system-site-packages'),
+        ({'batch': 'manifest.txt', 'jobs': '3'}, ('--system-site-packages',)),
+    ), (
+        ('--stage2', '--no-build', 'a', 'b'),
+        ({'no-build': True}, ('--stage2', 'a', 'b')),
+    ), (
+        ('--batch=a', '--batch=b'),
+        ({'batch': 'b'}, ()),
+    ),
+])
+def test_parseopts(args, expected):
+    assert venv_update.parseopts(args) == expected
+
+
+def test_formatopts():
+    options = {'batch': 'manifest.txt', 'no-build': True}
+    assert venv_update.formatopts(options) == ('--batch=manifest.txt', '--no-build')
+    assert venv_update.parseopts(venv_update.formatopts(options)) == (options, ())
+
+
+def test_requirements_lines(tmpdir):
+    tmpdir.chdir()
+    tmpdir.join('reqs.txt').write('''\
+-r sub/reqs2.txt
+# a comment here
+mccabe  # trailing comment
+
+-i https://example.com/simple
+--allow-external mccabe
+-e git+https://example.com/a.git#egg=a
+--requirement=sub/reqs2.txt
+''')
+    tmpdir.join('sub').mkdir()
+    tmpdir.join('sub/reqs2.txt').write('pep8==1.0\n-r ../reqs.txt\n')
+
+    assert list(venv_update.requirements_lines(('reqs.txt',))) == [
+        ('sub/reqs2.txt', 'pep8==1.0'),
+        ('reqs.txt', 'mccabe'),
+        ('reqs.txt', '-i https://example.com/simple'),
+        ('reqs.txt', '--allow-external mccabe'),
+        ('reqs.txt', '-e git+https://example.com/a.git#egg=a'),
+    ]
+    assert venv_update.pip_options(('reqs.txt',)) == ['-i https://example.com/simple', '--allow-external mccabe']
+
+
+class FakeReq(object):
+    def __init__(self, name, req=None, url=None, editable=False):
+        self.name = name
+        self.req = req
+        self.url = url
+        self.editable = editable
+        self.source_dir = None
+
+    def __str__(self):
+        return str(self.req or self.url)
+
+
+def test_requirement_rounds():
+    reqs = [
+        FakeReq('a', 'a==1'),
+        FakeReq('b', 'b==1'),
+        FakeReq(None, url='file:///my/random/project'),
+        FakeReq('a', 'a==1'),
+        FakeReq('A', 'A==2'),
+        FakeReq('b', 'b==1'),
+        FakeReq('c', 'c', url='git+git://github.com/c/c.git#egg=c', editable=True),
+        FakeReq('a', 'a==3'),
+    ]
+    assert venv_update.requirement_rounds(reqs) == [
+        ['a==1', 'b==1', 'file:///my/random/project', '-e git+git://github.com/c/c.git#egg=c'],
+        ['A==2'],
+        ['a==3'],
+    ]
+
+
+def test_parse_manifest(tmpdir):
+    tmpdir.chdir()
+    tmpdir.join('manifest.txt').write('''\
+# one virtualenv per line
+foo/venv foo/requirements.txt  # with a comment
+
+bar/venv --python=python3 bar/requirements.txt bar/requirements-dev.txt
+baz/venv
+''')
+    assert venv_update.parse_manifest('manifest.txt') == [
+        ('foo/venv', ('foo/requirements.txt',), ()),
+        ('bar/venv', ('bar/requirements.txt', 'bar/requirements-dev.txt'), ('--python=python3',)),
+        ('baz/venv', ('requirements.txt',), ()),
+    ]
+
+
+def test_run_parallel(capfd):
+    cmds = [
+        ('sh', '-c', 'sleep 0.2; echo first'),
+        ('sh', '-c', 'echo second; exit 3'),
+        ('sh', '-c', 'echo third'),
+    ]
+    assert venv_update.run_parallel(cmds, 2) == [0, 3, 0]
+
+    out, err = capfd.readouterr()
+    assert err == ''
+    # each command's output is shown together, right after the command
+    out = out.splitlines()
+    assert sorted(out[1::2]) == ['first', 'second', 'third']
+    for cmd_line, output_line in zip(out[::2], out[1::2]):
+        assert output_line in cmd_line
+
+
+def test_requirements_fingerprint(tmpdir):
+    tmpdir.chdir()
+    tmpdir.join('reqs.txt').write('-r reqs2.txt\nmccabe\n')
+    tmpdir.join('reqs2.txt').write('pep8==1.0\n')
+    fingerprint = venv_update.requirements_fingerprint(('reqs.txt',))
+
+    # comments and whitespace don't matter
+    tmpdir.join('reqs.txt').write('# hi\n-r reqs2.txt\n\nmccabe  # there\n')
+    assert venv_update.requirements_fingerprint(('reqs.txt',)) == fingerprint
+
+    # but changing an included file does
+    tmpdir.join('reqs2.txt').write('pep8==1.1\n')
+    assert venv_update.requirements_fingerprint(('reqs.txt',)) != fingerprint
+
+
+def test_cached_parse_requirements(tmpdir, monkeypatch):
+    tmpdir.chdir()
+    monkeypatch.setenv('HOME', tmpdir.strpath)
+    tmpdir.join('reqs.txt').write('mccabe\n')
+
+    calls = []
+
+    def fake_parse(requirement_files):
+        calls.append(requirement_files)
+        return ['parsed', len(calls)]
+    monkeypatch.setattr(venv_update, 'pip_parse_requirements', fake_parse)
+
+    assert venv_update.cached_parse_requirements(('reqs.txt',)) == ['parsed', 1]
+    assert venv_update.cached_parse_requirements(('reqs.txt',)) == ['parsed', 1]
+    assert len(calls) == 1
+
+    tmpdir.join('reqs.txt').write('mccabe\npep8\n')
+    assert venv_update.cached_parse_requirements(('reqs.txt',)) == ['parsed', 2]
+    # the old parse is gone, but another set of requirements files keeps its own
+    tmpdir.join('other.txt').write('mccabe\n')
+    assert venv_update.cached_parse_requirements(('other.txt',)) == ['parsed', 3]
+    assert len(tmpdir.join('.pip/venv-update/requirements').listdir('*.pickle')) == 2
+
+    # a corrupt cache is parsed again
+    for pickled in tmpdir.join('.pip/venv-update/requirements').listdir('*.pickle'):
+        pickled.write('garbage')
+    assert venv_update.cached_parse_requirements(('reqs.txt',)) == ['parsed', 4]
+
+    # a missing file gets pip's usual error
+    assert venv_update.cached_parse_requirements(('missing.txt',)) == ['parsed', 5]
+
+
+def test_interpreter_identity():
+    from sys import executable
+    assert venv_update.interpreter_identity(executable) == venv_update.interpreter_identity()
+    assert venv_update.interpreter_identity('/no/such/python') is None
+
+
+@pytest.mark.parametrize('args,expected', [
+    (
+        (),
+        (None, False, []),
+    ), (
+        ('--system-site-packages', '-q', '--prompt=(wat)'),
+        (None, True, ['--prompt=(wat)']),
+    ), (
+        ('--system-site-packages', '--no-site-packages', '--verbose'),
+        (None, False, []),
+    ), (
+        ('--python=/no/such/python',),
+        ('/no/such/python', False, []),
+    ), (
+        ('-p/no/such/python',),
+        ('/no/such/python', False, []),
+    ),
+])
+def test_venv_spec(args, expected, monkeypatch):
+    monkeypatch.setattr(venv_update, 'interpreter_identity', lambda python=None: python)
+    python, system_site_packages, args_left = expected
+    assert venv_update.venv_spec(args) == {
+        'python': python,
+        'system_site_packages': system_site_packages,
+        'args': args_left,
+    }
+
+
+def test_json_roundtrip(tmpdir):
+    path = tmpdir.join('a/b/c.json').strpath
+    assert venv_update.read_json(path) is None
+
+    venv_update.write_json(path, {'a': [1, 'b']})
+    assert venv_update.read_json(path) == {'a': [1, 'b']}
+
+    tmpdir.join('a/b/c.json').write('{"trunca')
+    assert venv_update.read_json(path) is None
+
+
+def test_venv_set_system_site_packages(tmpdir):
+    assert venv_update.venv_set_system_site_packages(tmpdir.strpath, True) is False
+
+    lib_dir = tmpdir.join('lib/python2.7')
+    lib_dir.ensure('orig-prefix.txt')
+    no_global = lib_dir.join('no-global-site-packages.txt')
+
+    assert venv_update.venv_set_system_site_packages(tmpdir.strpath, False) is True
+    assert no_global.check(file=True)
+    assert venv_update.venv_set_system_site_packages(tmpdir.strpath, True) is True
+    assert not no_global.exists()
+    assert venv_update.venv_set_system_site_packages(tmpdir.strpath, True) is True
+    assert not no_global.exists()
+
+
+def test_venv_observed_spec(tmpdir, monkeypatch):
+    monkeypatch.setattr(venv_update, 'interpreter_identity', lambda python=None: python)
+    lib_dir = tmpdir.join('lib/python2.7')
+    lib_dir.ensure('orig-prefix.txt')
+    assert venv_update.venv_observed_spec(tmpdir.strpath, ('--prompt=(wat)',)) == {
+        'python': tmpdir.join('bin/python').strpath,
+        'system_site_packages': True,
+        'args': ['--prompt=(wat)'],
+    }
+    lib_dir.ensure('no-global-site-packages.txt')
+    assert venv_update.venv_observed_spec(tmpdir.strpath, ())['system_site_packages'] is False
+
+
+def fake_dists(**requires):
+    """Make some distributions, each with the given requirements, per extra."""
+    from pkg_resources import Distribution, Requirement
+
+    class FakeDist(Distribution):
+        deps = {}
+
+        def requires(self, extras=()):
+            deps = self.deps.get(None, [])
+            for extra in extras:
+                deps = deps + self.deps[extra]
+            return [Requirement.parse(dep) for dep in deps]
+
+    dists = {}
+    for name, deps in requires.items():
+        name, version = name.split('_')
+        dist = FakeDist(project_name=name, version=version)
+        dist.deps = deps if isinstance(deps, dict) else {None: deps}
+        dists[dist.key] = dist
+    return dists
+
+
+def graph_of(dists, *reqs):
+    from pkg_resources import Requirement
+    graph = venv_update.DependencyGraph(lambda req: dists.get(req.key))
+    return graph.add([FakeReq(req.split('=')[0], Requirement.parse(req)) for req in reqs])
+
+
+def test_dependency_graph_diamond():
+    dists = fake_dists(
+        a_1=['b', 'c'],
+        b_1=['d>=1'],
+        c_1=['d<2'],
+        d_1=[],
+        e_1=['a'],
+    )
+    graph = graph_of(dists, 'e', 'a==1')
+    assert graph.order == ['e', 'a', 'b', 'c', 'd']
+    assert graph.edges == {'e': ['a'], 'a': ['b', 'c'], 'b': ['d'], 'c': ['d'], 'd': []}
+    assert graph.roots == ['e', 'a']
+    assert graph.required_as['d'] == 'd>=1 (from b (from a==1))'
+    assert graph.conflicts == graph.missing == graph.cycles() == []
+    assert graph.install_order() == ['d', 'b', 'c', 'a', 'e']
+
+
+def test_dependency_graph_problems():
+    dists = fake_dists(
+        a_1=['b==2', 'missing'],
+        b_1=['c'],
+        c_1=['a'],
+    )
+    graph = graph_of(dists, 'a')
+    assert graph.order == ['a', 'b', 'c']
+    assert [(str(req), str(dist), description) for req, dist, description in graph.conflicts] == [
+        ('b==2', 'b 1', 'b==2 (from a)'),
+    ]
+    assert [(str(req), description) for req, description in graph.missing] == [
+        ('missing', 'missing (from a)'),
+    ]
+    assert graph.cycles() == [['a', 'b', 'c']]
+    assert graph.install_order() == ['c', 'b', 'a']
+
+
+def test_dependency_graph_extras():
+    dists = fake_dists(
+        a_1={None: ['b'], 'x': ['c'], 'y': ['d']},
+        b_1=[],
+        c_1=[],
+        d_1=[],
+        e_1=['a[y]'],
+    )
+    graph = graph_of(dists, 'a')
+    assert graph.order == ['a', 'b']
+
+    graph = graph_of(dists, 'a[x]', 'e')
+    assert graph.order == ['a', 'e', 'b', 'c', 'd']
+    assert graph.edges['a'] == ['b', 'c', 'd']
+
+
+def test_unique():
+    assert venv_update.unique('abacbd') == ['a', 'b', 'c', 'd']
+
+
+@pytest.mark.parametrize('url,expected', [
+    (
+        'git+git://github.com/bukzor/cov-core.git@' + 'a' * 40 + '#egg=cov-core',
+        ('git://github.com/bukzor/cov-core.git', 'a' * 40),
+    ), (
+        'hg+https://bitbucket.org/logilab/pylint@58c66aa083777059a2e6b46f6a0545a2f4977097',
+        ('https://bitbucket.org/logilab/pylint', '58c66aa083777059a2e6b46f6a0545a2f4977097'),
+    ), (
+        'git+ssh://git@github.com/Yelp/venv-update.git@' + 'b' * 40,
+        ('ssh://git@github.com/Yelp/venv-update.git', 'b' * 40),
+    ), (
+        'svn+http://svn.example.com/project@123#egg=project',
+        ('http://svn.example.com/project', None),
+    ),
+])
+def test_vcs_commit(url, expected):
+    assert venv_update.vcs_commit(url) == expected
+
+
+def test_vcs_commit_git_ref(tmpdir):
+    tmpdir.chdir()
+    from subprocess import check_call, check_output
+
+    def git(*args):
+        check_call(('git', '-C', 'repo', '-c', 'user.name=a', '-c', 'user.email=a@b') + args)
+
+    check_call(('git', 'init', '-q', 'repo'))
+    git('commit', '-q', '--allow-empty', '-m', 'a')
+    commit = check_output(('git', '-C', 'repo', 'rev-parse', 'HEAD')).decode('UTF-8').strip()
+    git('tag', 'v1')
+    git('tag', '-a', '-m', 'annotated', 'v2')
+    # a branch whose name ends the same as another's
+    git('branch', '-M', 'master')
+    git('checkout', '-q', '-b', 'foo/master')
+    git('commit', '-q', '--allow-empty', '-m', 'b')
+
+    url = 'file://' + tmpdir.join('repo').strpath
+    assert venv_update.vcs_commit('git+' + url + '@v1#egg=repo') == (url, commit)
+    # the commit, not the tag object
+    assert venv_update.vcs_commit('git+' + url + '@v2#egg=repo') == (url, commit)
+    assert venv_update.vcs_commit('git+' + url + '@master#egg=repo') == (url, commit)
+    assert venv_update.vcs_commit('git+' + url + '@nonesuch#egg=repo') == (url, None)
+    git('checkout', '-q', 'master')
+    assert venv_update.vcs_commit('git+' + url + '#egg=repo') == (url, commit)
+
+
+def test_save_vcs_wheels(tmpdir, monkeypatch):
+    req = FakeReq('repo', url='git+https://example.com/repo@v1#egg=repo')
+    tmpdir.join('wheels/repo-1.0-py2-none-any.whl').write('built', ensure=True)
+    # a wheel of the same project, from some other build
+    tmpdir.join('wheels/repo-0.9-py2-none-any.whl').write('other')
+    monkeypatch.setattr(venv_update, 'BUILT_WHEELS', {
+        req.url: [tmpdir.join('wheels/repo-1.0-py2-none-any.whl').strpath],
+    })
+
+    venv_update.save_vcs_wheels([(req, tmpdir.join('cache').strpath)])
+    assert [path.basename for path in tmpdir.join('cache').listdir()] == ['repo-1.0-py2-none-any.whl']
+    assert tmpdir.join('cache/repo-1.0-py2-none-any.whl').read() == 'built'
+
+
+def test_git_ref_commit():
+    refs = '\n'.join((
+        'a' * 40 + '\tHEAD',
+        'b' * 40 + '\trefs/heads/foo/master',
+        'c' * 40 + '\trefs/heads/master',
+        'd' * 40 + '\trefs/tags/v1',
+        'e' * 40 + '\trefs/tags/v1^{}',
+        'f' * 40 + '\trefs/tags/master',
+    )) + '\n'
+    assert venv_update.git_ref_commit(refs, 'HEAD') == 'a' * 40
+    # a branch before a tag, as pip does
+    assert venv_update.git_ref_commit(refs, 'master') == 'c' * 40
+    assert venv_update.git_ref_commit(refs, 'v1') == 'e' * 40
+    assert venv_update.git_ref_commit(refs, 'refs/tags/v1') == 'e' * 40
+    assert venv_update.git_ref_commit(refs, 'foo') is None
+    assert venv_update.git_ref_commit('', 'HEAD') is None
+
+
+def test_unchanged_editables(tmpdir, monkeypatch):
+    import sys
+    import distutils.sysconfig  # pylint:disable=no-name-in-module,import-error
+    site_packages = tmpdir.join('venv/site-packages').ensure(dir=True)
+    monkeypatch.setattr(distutils.sysconfig, 'get_python_lib', lambda: site_packages.strpath)
+    monkeypatch.setattr(sys, 'prefix', tmpdir.join('venv').strpath)
+
+    project = tmpdir.join('project')
+    project.ensure('setup.py').write('from setuptools import setup\nsetup(name="project")\n')
+    project.ensure('src/project.egg-info/PKG-INFO').write('Metadata-Version: 1.0\nName: project\nVersion: 0.0.0\n')
+
+    req = FakeReq(None, url='file://' + project.strpath, editable=True)
+    req.source_dir = project.strpath
+    required = [req, FakeReq('mccabe', 'mccabe')]
+
+    # not installed yet
+    assert venv_update.installed_egg_links() == {}
+    venv_update.record_editables(required)
+    assert list(venv_update.unchanged_editables(required)) == []
+
+    site_packages.join('project.egg-link').write(project.join('src').strpath + '\n../\n')
+    assert venv_update.installed_egg_links() == {project.strpath: project.join('src').strpath}
+    venv_update.record_editables(required)
+    assert venv_update.unchanged_editables(required) == [req]
+    assert str(req.req) == 'project'
+
+    # touching setup.py matters
+    project.join('setup.py').write('from setuptools import setup\nsetup(name="project", version="1")\n')
+    assert venv_update.unchanged_editables(required) == []
+
+
+def test_clone_venv(tmpdir):
+    src = tmpdir.join('venv')
+    src.ensure('bin/python').write('python')
+    src.ensure('lib/site-packages/foo.py').write('foo')
+    src.ensure('lib/site-packages/easy-install.pth').write('./bar\n')
+    src.join('local').mksymlinkto(src.join('lib'))
+    src.join('outside').mksymlinkto('/etc')
+
+    dst = tmpdir.join('clone')
+    venv_update.clone_venv(src.strpath, dst.strpath)
+
+    def inode(path):
+        return path.lstat().ino
+
+    assert inode(dst.join('lib/site-packages/foo.py')) == inode(src.join('lib/site-packages/foo.py'))
+    assert inode(dst.join('lib/site-packages/easy-install.pth')) != inode(src.join('lib/site-packages/easy-install.pth'))
+    assert inode(dst.join('bin/python')) != inode(src.join('bin/python'))
+    assert dst.join('bin/python').read() == 'python'
+    assert dst.join('lib/site-packages/easy-install.pth').read() == './bar\n'
+
+    assert dst.join('local').readlink() == 'lib'
+    assert dst.join('local/site-packages/foo.py').read() == 'foo'
+    assert dst.join('outside').readlink() == '/etc'
+
+
+def test_venv_transaction(tmpdir):
+    tmpdir.chdir()
+    venv = tmpdir.join('venv')
+    venv.ensure('lib/foo.py').write('foo')
+
+    with pytest.raises(ValueError):
+        with venv_update.venv_transaction('venv') as shadow:
+            tmpdir.join(shadow).join('lib/foo.py').remove()
+            raise ValueError('oops')
+    assert venv.join('lib/foo.py').read() == 'foo'
+    assert sorted(path.basename for path in tmpdir.listdir()) == ['venv']
+
+    with venv_update.venv_transaction('venv') as shadow:
+        tmpdir.join(shadow).join('lib/foo.py').remove()
+        tmpdir.join(shadow).join('lib/bar.py').write('bar')
+    assert not venv.join('lib/foo.py').exists()
+    assert venv.join('lib/bar.py').read() == 'bar'
+    assert sorted(path.basename for path in tmpdir.listdir()) == ['venv']
+
+    # a brand new virtualenv, which knows itself by the shadow's path until it's swapped into place
+    with venv_update.venv_transaction('venv2') as shadow:
+        shadow = tmpdir.join(shadow)
+        shadow.ensure('lib/baz.py')
+        shadow.ensure('bin/activate').write('VIRTUAL_ENV="{0}"\n'.format(shadow.strpath))
+        venv_update.write_json(venv_update.venv_state_path(shadow.strpath, 'installed.json'), {
+            'paths': {shadow.join('lib').strpath: 1},
+        })
+    venv2 = tmpdir.join('venv2')
+    assert venv2.join('lib/baz.py').exists()
+    assert venv2.join('bin/activate').read() == 'VIRTUAL_ENV="{0}"\n'.format(venv2.strpath)
+    assert venv_update.read_json(venv_update.venv_state_path(venv2.strpath, 'installed.json')) == {
+        'paths': {venv2.join('lib').strpath: 1},
+    }
+
+
+def test_event_disabled(tmpdir, monkeypatch):
+    tmpdir.chdir()
+    monkeypatch.delenv(venv_update.EVENTS_ENVIRON, raising=False)
+    venv_update.event('hello', a=1)
+    assert tmpdir.listdir() == []
+
+
+def read_events(events_path):
+    import json
+    return [json.loads(line) for line in events_path.readlines()]
+
+
+def test_events(tmpdir, monkeypatch):
+    events_path = tmpdir.join('events.jsonl')
+    monkeypatch.setenv(venv_update.EVENTS_ENVIRON, events_path.strpath)
+
+    venv_update.event('hello', a=1)
+    with venv_update.phase('install'):
+        with venv_update.timed_event('build', name='pep8') as fields:
+            fields['bytes'] = 3
+    with pytest.raises(ValueError):
+        with venv_update.timed_event('download', url='http://example.com'):
+            raise ValueError('oops')
+
+    events = read_events(events_path)
+    assert [event['event'] for event in events] == ['hello', 'phase-start', 'build', 'phase-end', 'download']
+    hello, start, build, end, download = events
+    assert hello['a'] == 1
+    assert start['phase'] == end['phase'] == 'install'
+    assert end['success'] is True
+    assert build['name'] == 'pep8'
+    assert build['bytes'] == 3
+    assert build['success'] is True
+    assert end['seconds'] >= build['seconds'] >= 0
+    assert download['success'] is False
+    for event in events:
+        assert event['time'] > 0
+        assert event['pid'] > 0
+
+
+def test_pip_events_install(tmpdir, monkeypatch):
+    from pip.req import InstallRequirement
+    events_path = tmpdir.join('events.jsonl')
+    monkeypatch.setenv(venv_update.EVENTS_ENVIRON, events_path.strpath)
+    installed = []
+    monkeypatch.setattr(InstallRequirement, 'install', lambda self, *args: installed.append(self.name))
+
+    wheel = tmpdir.join('a-1.0-py2.py3-none-any.whl')
+    wheel.write('wheel')
+    req = InstallRequirement.from_line('a==1.0')
+    # pip notes where it found the requirement as a url, fragment and all
+    req.url = 'file://' + wheel.strpath + '#md5=0123'
+    with venv_update.pip_events():
+        req.install([])
+    assert installed == ['a']
+
+    install, = read_events(events_path)
+    assert install['event'] == 'install'
+    assert install['name'] == 'a'
+    assert install['bytes'] == 5
+    assert install['success'] is True
+
+
+def test_run(capfd):
+    venv_update.run(('echo', 'hi'))
+    out, err = capfd.readouterr()
+    assert err == ''
+    assert out == '> echo hi\nhi\n'
+
+
+def test_report_cache_counters(capsys, monkeypatch):
+    monkeypatch.setattr(venv_update, 'CACHE_COUNTERS', {})
+    venv_update.report_cache_counters()
+    assert capsys.readouterr() == ('', '')
+
+    venv_update.count_cache('fast-path', 'hit', 'wheelhouse')
+    venv_update.count_cache('fast-path', 'hit', 'wheelhouse')
+    venv_update.count_cache('fast-path', 'miss', 'unpinned')
+    venv_update.count_cache('download-cache', 'miss')
+    venv_update.report_cache_counters()
+    out, err = capsys.readouterr()
+    assert err == ''
+    assert out == '''\
+Cache counters:
+  download-cache miss: 1
+  fast-path hit (wheelhouse): 2
+  fast-path miss (unpinned): 1
+'''
+
+
+def test_atomic_file(tmpdir):
+    path = tmpdir.join('sub/file')
+    with venv_update.atomic_file(path.strpath) as atomic:
+        atomic.write(b'hello')
+        # nobody can see it yet
+        assert not path.exists()
+    assert path.read() == 'hello'
+
+    with pytest.raises(ValueError):
+        with venv_update.atomic_file(path.strpath) as atomic:
+            atomic.write(b'goodbye')
+            raise ValueError('oops')
+    # the original is untouched, and the partial file is cleaned up
+    assert path.read() == 'hello'
+    assert tmpdir.join('sub').listdir() == [path]
+
+
+def test_wait_for_lock(tmpdir):
+    from os.path import abspath, dirname
+    from subprocess import Popen, PIPE
+    from sys import executable
+    from time import time
+
+    lock = tmpdir.join('locks/a.lock')
+    assert venv_update.wait_for_lock(lock.strpath) is False
+
+    # another process holds the lock, for a little while
+    holder = Popen((executable, '-c', '''\
+import sys, time, venv_update
+with venv_update.file_lock(sys.argv[1]):
+    print('locked')
+    sys.stdout.flush()
+    time.sleep(0.3)
+''', lock.strpath), stdout=PIPE, cwd=dirname(abspath(venv_update.__file__)))
+    assert holder.stdout.readline() == b'locked\n'
+
+    start = time()
+    assert venv_update.wait_for_lock(lock.strpath) is True
+    assert time() - start > 0.1
+    assert holder.wait() == 0
+
+    with venv_update.file_lock(lock.strpath):
+        pass
+    assert venv_update.wait_for_lock(lock.strpath) is False
+
+
+def test_locked_update(tmpdir, monkeypatch):
+    from contextlib import contextmanager
+    tmpdir.chdir()
+    monkeypatch.setenv('HOME', tmpdir.strpath)
+    tmpdir.join('requirements.txt').write('pep8==1.0\n')
+
+    state = {'waited': False, 'exit_code': None}
+
+    @contextmanager
+    def file_lock(dummy_path, inheritable=False):
+        state['inheritable'] = inheritable
+        yield state['waited']
+    monkeypatch.setattr(venv_update, 'file_lock', file_lock)
+
+    updates = []
+
+    def update_or_invalidate(dummy_stage, venv_path, dummy_reqs, dummy_venv_args, options):
+        state['options'] = options
+        updates.append(venv_path)
+        tmpdir.join(venv_path).ensure(dir=True)
+        return state['exit_code']
+    monkeypatch.setattr(venv_update, 'update_or_invalidate', update_or_invalidate)
+
+    def locked_update(options=None):
+        return venv_update.locked_update('venv', ('requirements.txt',), (), options or {})
+
+    assert locked_update() is None
+    assert len(updates) == 1
+
+    # another process did just what we wanted, while we waited
+    state['waited'] = True
+    assert locked_update() == 0
+    assert len(updates) == 1
+
+    # but not if it was a different update
+    tmpdir.join('requirements.txt').write('pep8==1.1\n')
+    assert locked_update() is None
+    assert len(updates) == 2
+
+    # nor if it failed
+    state['exit_code'] = 1
+    state['waited'] = False
+    assert locked_update() == 1
+    state['waited'] = True
+    state['exit_code'] = 0
+    assert locked_update() == 0
+    assert len(updates) == 4
+
+    # nor if we didn't wait
+    state['waited'] = False
+    locked_update()
+    assert len(updates) == 5
+    assert state['inheritable'] is None
+    assert 'last-update' not in state['options']
+
+    # with --single-process, stage2 holds the lock, and records the update, in our place
+    locked_update({'single-process': True})
+    assert state['inheritable'] is True
+    assert state['options']['last-update'] == venv_update.update_fingerprint(('requirements.txt',), ())
+
+
+def make_wheel(path, members):
+    """Write a zip file, from a list of (name, data, compress_type, mode)."""
+    import zipfile
+    wheel = zipfile.ZipFile(path.strpath, 'w')
+    try:
+        for name, data, compress_type, mode in members:
+            info = zipfile.ZipInfo(name)
+            info.compress_type = compress_type
+            info.external_attr = mode << 16
+            wheel.writestr(info, data)
+    finally:
+        wheel.close()
+
+
+def test_unpack_wheel(tmpdir, monkeypatch):
+    import os
+    import stat
+    from zipfile import ZIP_DEFLATED, ZIP_STORED
+    monkeypatch.setattr(venv_update, 'UNPACK_BLOCK_SIZE', 7)
+
+    big = b''.join(str(i).encode('UTF-8') for i in range(10000))
+    make_wheel(tmpdir.join('a.whl'), [
+        ('a/', b'', ZIP_STORED, 0o40755),
+        ('a/__init__.py', b'# stored\n', ZIP_STORED, 0o100644),
+        ('a/big.dat', big, ZIP_DEFLATED, 0o100644),
+        ('a/stored.dat', big, ZIP_STORED, 0o100644),
+        ('a-1.0.data/scripts/a', b'#!python\n', ZIP_DEFLATED, 0o100755),
+        ('a-1.0.dist-info/RECORD', b'', ZIP_DEFLATED, 0),
+    ])
+    dest = tmpdir.join('dest')
+    venv_update.unpack_wheel(tmpdir.join('a.whl').strpath, dest.strpath)
+
+    assert dest.join('a/__init__.py').read_binary() == b'# stored\n'
+    assert dest.join('a/big.dat').read_binary() == big
+    assert dest.join('a/stored.dat').read_binary() == big
+    assert dest.join('a-1.0.dist-info/RECORD').read_binary() == b''
+    script = dest.join('a-1.0.data/scripts/a')
+    assert script.read_binary() == b'#!python\n'
+    assert os.stat(script.strpath).st_mode & stat.S_IXUSR
+    assert not os.stat(dest.join('a/__init__.py').strpath).st_mode & stat.S_IXUSR
+
+
+def test_unpack_wheel_unsafe(tmpdir):
+    from zipfile import BadZipfile, ZIP_STORED
+    make_wheel(tmpdir.join('a.whl'), [('../evil.py', b'', ZIP_STORED, 0o100644)])
+    with pytest.raises(BadZipfile):
+        venv_update.unpack_wheel(tmpdir.join('a.whl').strpath, tmpdir.join('dest').strpath)
+    assert not tmpdir.join('evil.py').exists()
+
+
+@pytest.mark.parametrize('compress_type', ['ZIP_STORED', 'ZIP_DEFLATED'])
+def test_unpack_wheel_bad_crc(tmpdir, compress_type):
+    import zipfile
+    from zipfile import BadZipfile
+    wheel = tmpdir.join('a.whl')
+    make_wheel(wheel, [('a.py', b'x' * 1000, getattr(zipfile, compress_type), 0o100644)])
+    # corrupt the member's CRC, in its central directory entry
+    data = bytearray(wheel.read_binary())
+    central = data.rindex(b'PK\x01\x02')
+    data[central + 16] ^= 0xff
+    wheel.write_binary(bytes(data))
+
+    with pytest.raises(BadZipfile):
+        venv_update.unpack_wheel(wheel.strpath, tmpdir.join('dest').strpath)
+
+
+def test_move_file(tmpdir, monkeypatch):
+    import errno
+    import os
+    source = tmpdir.join('source')
+    source.write('a')
+    source.chmod(0o755)
+    dest = tmpdir.join('dest')
+    shutil = venv_update.moving_shutil()
+    shutil.copy2(source.strpath, dest.strpath)
+    assert not source.exists()
+    assert dest.read() == 'a'
+    assert dest.stat().mode & 0o777 == 0o755
+
+    # across filesystems, it's copied
+    def rename(dummy_source, dummy_dest):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+    monkeypatch.setattr(os, 'rename', rename)
+    shutil.copy2(dest.strpath, source.strpath)
+    assert source.read() == dest.read() == 'a'
+    assert source.stat().mode & 0o777 == 0o755
+
+    # the rest of shutil is as it was
+    import shutil as real_shutil
+    assert shutil.move is real_shutil.move
+    assert real_shutil.copy2 is not venv_update.move_file
+
+
+def test_stage2_options():
+    assert venv_update.stage2_options({'compile': 'new', 'transactional': True, 'jobs': '3'}) == ('--compile=new',)
+    assert venv_update.stage2_options({}) == ()
+
+
+def test_compile_source(tmpdir):
+    from os.path import exists
+    good = tmpdir.join('good.py')
+    good.write('x = 1\n')
+    bad = tmpdir.join('bad.py')
+    bad.write('x = \n')
+
+    assert venv_update.compile_source(good.strpath) is None
+    bytecode = venv_update.bytecode_path(good.strpath)
+    assert exists(bytecode)
+
+    # it's up to date, so it's left alone
+    Path(bytecode).setmtime(good.mtime() + 10)
+    mtime = Path(bytecode).mtime()
+    assert venv_update.compile_source(good.strpath) is None
+    assert Path(bytecode).mtime() == mtime
+
+    assert 'bad.py' in venv_update.compile_source(bad.strpath)
+    assert not exists(venv_update.bytecode_path(bad.strpath))
+
+
+def test_compile_parallel(tmpdir, capsys):
+    from os.path import exists
+    sources = []
+    for number in range(10):
+        source = tmpdir.join('mod{0}.py'.format(number))
+        source.write('x = {0}\n'.format(number))
+        sources.append(source.strpath)
+    tmpdir.join('bad.py').write('x = \n')
+
+    venv_update.compile_parallel(sources + [tmpdir.join('bad.py').strpath])
+    for source in sources:
+        assert exists(venv_update.bytecode_path(source))
+    out, _ = capsys.readouterr()
+    assert 'bad.py' in out
+
+
+class FakeMetadataDist(object):
+    def __init__(self, location, egg_info, metadata):
+        self.location = location
+        self.egg_info = egg_info
+        self.metadata = metadata
+
+    def has_metadata(self, name):
+        return name in self.metadata
+
+    def get_metadata_lines(self, name):
+        return self.metadata[name].splitlines()
+
+
+def test_installed_files():
+    dist = FakeMetadataDist('/site', '/site/a.dist-info', {
+        'RECORD': 'a/__init__.py,sha256=abc,3\n"a/b,c.py",sha256=def,4\na.dist-info/RECORD,,\n',
+    })
+    assert venv_update.installed_files(dist) == [
+        '/site/a/__init__.py', '/site/a/b,c.py', '/site/a.dist-info/RECORD',
+    ]
+
+    dist = FakeMetadataDist('/site', '/site/b.egg-info', {
+        'installed-files.txt': '../b.py\nPKG-INFO\n',
+    })
+    assert venv_update.installed_files(dist) == ['/site/b.py', '/site/b.egg-info/PKG-INFO']
+
+    assert venv_update.installed_files(FakeMetadataDist('/src', None, {})) == []
+
+
+def make_dist_wheel(wheel_dir, filename, metadata):
+    from zipfile import ZIP_DEFLATED
+    name_version = '-'.join(filename.split('-')[:2])
+    make_wheel(wheel_dir.join(filename), [
+        (name_version + '/__init__.py', b'', ZIP_DEFLATED, 0o100644),
+        (name_version + '.dist-info/METADATA', metadata.encode('UTF-8'), ZIP_DEFLATED, 0o100644),
+    ])
+
+
+def test_wheel_sidecar(tmpdir):
+    wheel_dir = tmpdir.ensure('wheelhouse', dir=True)
+    make_dist_wheel(wheel_dir, 'a_b-1.0-py2.py3-none-any.whl', '''\
+Metadata-Version: 2.0
+Name: a-b
+Version: 1.0
+Provides-Extra: fast
+Requires-Dist: c (>=2)
+Requires-Dist: d; python_version < "3"
+Requires-Dist: e; extra == 'fast'
+''')
+    wheel = wheel_dir.join('a_b-1.0-py2.py3-none-any.whl')
+    sidecar = venv_update.wheel_sidecar(wheel.strpath)
+    assert sidecar['name'] == 'a-b'
+    assert sidecar['version'] == '1.0'
+    assert sidecar['requires'] == [['c (>=2)', None], ['d', 'python_version < "3"'], ['e', "extra == 'fast'"]]
+    assert sidecar['extras'] == ['fast']
+    assert sidecar['tags'] == [['py2', 'none', 'any'], ['py3', 'none', 'any']]
+    assert wheel_dir.join('.index/a_b-1.0-py2.py3-none-any.whl.json').check()
+
+    # the sidecar is used, while the wheel is unchanged
+    assert venv_update.wheel_sidecar(wheel.strpath) == sidecar
+
+
+def test_wheel_digest(tmpdir, monkeypatch):
+    from hashlib import sha256
+    wheel_dir = tmpdir.ensure('wheelhouse', dir=True)
+    make_dist_wheel(wheel_dir, 'a-1.0-py2.py3-none-any.whl', 'Metadata-Version: 2.0\nName: a\nVersion: 1.0\n')
+    wheel = wheel_dir.join('a-1.0-py2.py3-none-any.whl')
+
+    hashed = []
+    file_sha256 = venv_update.file_sha256
+    monkeypatch.setattr(venv_update, 'file_sha256', lambda path: hashed.append(path) or file_sha256(path))
+
+    sidecar = venv_update.wheel_sidecar(wheel.strpath)
+    assert sidecar['sha256'] == sha256(wheel.read_binary()).hexdigest()
+    assert sidecar['inode'] == wheel.stat().ino
+    assert len(hashed) == 1
+
+    # an unchanged wheel isn't hashed again
+    venv_update.verify_wheel(wheel.strpath)
+    assert len(hashed) == 1
+
+    # a wheel that was only touched is hashed again, once
+    wheel.setmtime(wheel.mtime() - 60)
+    venv_update.verify_wheel(wheel.strpath)
+    venv_update.verify_wheel(wheel.strpath)
+    assert len(hashed) == 2
+    assert venv_update.wheel_sidecar(wheel.strpath)['mtime'] == wheel.stat().mtime
+
+
+def test_verify_wheel_changed(tmpdir):
+    from pip.exceptions import HashMismatch
+    wheel_dir = tmpdir.ensure('wheelhouse', dir=True)
+    make_dist_wheel(wheel_dir, 'a-1.0-py2.py3-none-any.whl', 'Metadata-Version: 2.0\nName: a\nVersion: 1.0\n')
+    wheel = wheel_dir.join('a-1.0-py2.py3-none-any.whl')
+    sidecar = venv_update.wheel_sidecar(wheel.strpath)
+
+    wheel.write_binary(wheel.read_binary() + b'tampered')
+    with pytest.raises(HashMismatch) as excinfo:
+        venv_update.verify_wheel(wheel.strpath)
+    assert sidecar['sha256'] in str(excinfo.value)
+    # it's still refused, the next time
+    with pytest.raises(HashMismatch):
+        venv_update.verify_wheel(wheel.strpath)
+
+    # until it's added to the wheelhouse again
+    venv_update.index_wheels(wheel_dir.strpath, 0)
+    venv_update.verify_wheel(wheel.strpath)
+
+
+def test_wheelhouse_lookup(tmpdir):
+    from pip._vendor.pkg_resources import Requirement
+    wheel_dir = tmpdir.ensure('wheelhouse', dir=True)
+    for filename, requires in (
+            ('a-1.0-py2.py3-none-any.whl', 'Requires-Dist: b\nRequires-Dist: c; python_version < "0"\n'),
+            ('a-2.0-py2.py3-none-any.whl', ''),
+            ('a-3.0-cp99-cp99m-linux_x86_64.whl', ''),
+            ('b-1.0-py2.py3-none-any.whl', ''),
+    ):
+        name, version = filename.split('-')[:2]
+        make_dist_wheel(wheel_dir, filename, 'Metadata-Version: 2.0\nName: {0}\nVersion: {1}\n{2}'.format(
+            name, version, requires,
+        ))
+
+    lookup = venv_update.wheelhouse_lookup(wheel_dir.strpath, [('py3', 'none', 'any')])
+    # the newest supported wheel which satisfies the requirement
+    assert lookup(Requirement.parse('a')).version == '2.0'
+    assert lookup(Requirement.parse('a<2')).version == '1.0'
+    # if none satisfies it, pip would look elsewhere
+    assert lookup(Requirement.parse('a>5')) is None
+    assert lookup(Requirement.parse('c')) is None
+
+    graph = venv_update.DependencyGraph(lookup)
+    graph.add([FakeReq('a', Requirement.parse('a==1.0'))])
+    assert graph.order == ['a', 'b']
+    assert graph.missing == graph.conflicts == []
+
+
+def test_sidecar_metadata():
+    metadata = venv_update.SidecarMetadata({
+        'name': 'a', 'version': '1.0', 'extras': ['x'], 'requires': [['b', None], ['c', 'extra == "x"']],
+    })
+    assert metadata.has_metadata('METADATA')
+    assert metadata.get_metadata_lines('METADATA') == [
+        'Metadata-Version: 2.0',
+        'Name: a',
+        'Version: 1.0',
+        'Provides-Extra: x',
+        'Requires-Dist: b',
+        'Requires-Dist: c; extra == "x"',
+    ]
+    # the sidecar has nothing else to offer
+    assert not metadata.has_metadata('entry_points.txt')
+    with pytest.raises(KeyError):
+        metadata.get_metadata('entry_points.txt')
+
+
+def test_plan_targets(tmpdir, monkeypatch):
+    tmpdir.chdir()
+    monkeypatch.setenv('HOME', tmpdir.strpath)
+    wheel_dir = tmpdir.ensure('.pip/wheelhouse', dir=True)
+    for filename, requires in (
+            ('argparse-1.2.1-py2.py3-none-any.whl', ''),
+            ('wheel-0.24.0-py2.py3-none-any.whl', ''),
+            ('a-1.0-py2.py3-none-any.whl', 'Requires-Dist: b>=2\n'),
+            ('b-1.0-py2.py3-none-any.whl', ''),
+            ('c-3.0-py2.py3-none-any.whl', ''),
+    ):
+        name, version = filename.split('-')[:2]
+        make_dist_wheel(wheel_dir, filename, 'Metadata-Version: 2.0\nName: {0}\nVersion: {1}\n{2}'.format(
+            name, version, requires,
+        ))
+
+    # c is pinned to a version which isn't built; b is pinned to one which doesn't suit a
+    tmpdir.join('requirements.txt').write('a==1.0\nb==1.0\nc==2.0\n')
+    target, unresolved = venv_update.plan_targets(('requirements.txt',))
+    assert target == {'argparse': '1.2.1', 'wheel': '0.24.0', 'a': '1.0', 'b': '1.0', 'c': '2.0'}
+    assert [description.split()[0] for description in unresolved] == ['c==2.0', 'b>=2']
+
+    # so a downgrade from an installed c==3.0 is shown
+    installed = dict((key, {'version': version}) for key, version in target.items() if key != 'c')
+    installed['c'] = {'version': '3.0'}
+    assert venv_update.plan_diff(target, installed)['downgrade'] == [{'name': 'c', 'from': '3.0', 'to': '2.0'}]
+
+
+def test_manifest_drift(tmpdir):
+    venv = tmpdir.ensure('venv', dir=True)
+    venv.join('a.py').write('a')
+    venv.join('b.py').write('b')
+    outside = tmpdir.join('outside.py')
+    outside.write('outside')
+    venv.ensure('a.egg-info', dir=True)
+    files = venv_update.file_stats(['a.py', 'b.py', 'gone.py', 'a.egg-info', outside.strpath], venv.strpath)
+    assert sorted(files) == sorted(['a.py', 'b.py', outside.strpath])
+    assert files['a.py'] == [1, int(venv.join('a.py').mtime())]
+
+    manifest = {
+        'a': {'version': '1', 'files': {'a.py': files['a.py'], outside.strpath: files[outside.strpath]}},
+        'b': {'version': '1', 'files': {'b.py': files['b.py']}},
+        'c': {'version': '1', 'files': {}},
+    }
+    installed = {'a': {'version': '1'}, 'b': {'version': '1'}, 'c': {'version': '1'}}
+    assert venv_update.manifest_drift(manifest, installed, venv.strpath) == ([], [])
+
+    # the manifest still holds, once the virtualenv has moved
+    moved = tmpdir.join('moved')
+    venv.move(moved)
+    assert venv_update.manifest_drift(manifest, installed, moved.strpath) == ([], [])
+
+    moved.join('a.py').write('changed')
+    moved.join('b.py').remove()
+    installed['c']['version'] = '2'
+    installed['d'] = {'version': '1'}
+    assert venv_update.manifest_drift(manifest, installed, moved.strpath) == (['a', 'b', 'c'], ['d'])
+
+    del installed['c']
+    assert venv_update.manifest_drift(manifest, installed, moved.strpath) == (['a', 'b', 'c'], ['d'])
+
+    # virtualenv's own pip and setuptools are none of our business
+    manifest['pip'] = {'version': '1.5.6', 'files': {'gone.py': [1, 1]}}
+    installed['setuptools'] = {'version': '3.6'}
+    assert venv_update.manifest_drift(manifest, installed, moved.strpath) == (['a', 'b', 'c'], ['d'])
+
+
+def test_restat_manifest(tmpdir):
+    venv = tmpdir.ensure('venv', dir=True)
+    script = venv.ensure('bin/script')
+    manifest = {'fingerprint': 'f', 'dists': {'a': {'version': '1', 'files': {
+        'bin/script': venv_update.file_stats(['bin/script'], venv.strpath)['bin/script'],
+    }}}}
+    venv_update.write_json(venv_update.venv_state_path(venv.strpath, 'manifest.json'), manifest)
+
+    # as --relocatable would
+    script.write('#!/usr/bin/env python\n')
+    assert venv_update.manifest_drift(manifest['dists'], {'a': {'version': '1'}}, venv.strpath) == (['a'], [])
+
+    venv_update.restat_manifest(venv.strpath)
+    manifest = venv_update.read_json(venv_update.venv_state_path(venv.strpath, 'manifest.json'))
+    assert manifest['fingerprint'] == 'f'
+    assert venv_update.manifest_drift(manifest['dists'], {'a': {'version': '1'}}, venv.strpath) == ([], [])
+
+    # a virtualenv with no manifest is left alone
+    venv_update.restat_manifest(tmpdir.strpath)
+    assert not tmpdir.join('.venv-update').exists()
+
+
+def test_tox_requirements(tmpdir):
+    tmpdir.chdir()
+    tmpdir.join('setup.py').write('')
+    top = tmpdir.strpath
+    assert venv_update.tox_requirements((
+        '-rrequirements.d/test.txt', '--requirement', 'more.txt', '-i', 'https://example.com/simple',
+        'pytest==2.6.4', '-e', '.', '-e', 'git+https://example.com/a.git#egg=a',
+    )) == [
+        '-r ' + top + '/requirements.d/test.txt',
+        '--requirement ' + top + '/more.txt',
+        '-i https://example.com/simple',
+        'pytest==2.6.4',
+        '-e ' + top,
+        '-e git+https://example.com/a.git#egg=a',
+    ]
+    assert venv_update.tox_requirements(('--find-links=wheels', 'a')) == ['--find-links wheels', 'a']
+    assert venv_update.tox_requirements(()) == []
+
+    # not simply an install of some requirements
+    assert venv_update.tox_requirements(('-U', '--no-deps', 'dist/venv-update-0.1.zip')) is None
+    assert venv_update.tox_requirements(('--pre', 'pytest')) is None
+    assert venv_update.tox_requirements(('-r',)) is None
+
+
+def test_collapse_download_cache(tmpdir, monkeypatch):
+    try:
+        from urllib.parse import quote  # pylint:disable=no-name-in-module,import-error
+    except ImportError:  # python2
+        from urllib import quote
+    monkeypatch.setenv('HOME', tmpdir.strpath)
+    cache = tmpdir.ensure('cache', dir=True)
+    wheelhouse = tmpdir.ensure('wheelhouse', dir=True)
+    wheelhouse.ensure('pure_python-0.2.1-py2.py3-none-any.whl')
+    wheelhouse.ensure('wheeled-1.0-py2.py3-none-any.whl')
+    wheelhouse.ensure('compiled-1.0-cp27-none-linux_x86_64.whl')
+
+    def download(url, content):
+        cached = cache.join(quote(url, ''))
+        cached.write(content)
+        cache.join(quote(url, '') + '.content-type').write('application/x-tar')
+        return cached
+
+    built = download('https://example.com/packages/source/p/pure-python/pure-python-0.2.1.tar.gz', 'x' * 3)
+    unbuilt = download('https://example.com/packages/source/p/pure-python/pure-python-0.3.tar.gz', 'x' * 5)
+    wheeled = download('https://example.com/packages/wheeled-1.0-py2.py3-none-any.whl?md5=0', 'x' * 7)
+    other = download('https://example.com/simple/pure-python/', 'x' * 11)
+    # another python still needs to build its own wheel
+    compiled = download('https://example.com/packages/source/c/compiled/compiled-1.0.tar.gz', 'x' * 13)
+
+    assert venv_update.collapse_download_cache(cache.strpath, wheelhouse.strpath) == (2, 10)
+    assert not built.exists()
+    assert not wheeled.exists()
+    assert not cache.join(built.basename + '.content-type').exists()
+    assert unbuilt.exists()
+    assert other.exists()
+    assert compiled.exists()
+
+    assert venv_update.collapse_download_cache(cache.strpath, wheelhouse.strpath) == (0, 0)
+    assert venv_update.collapse_download_cache(tmpdir.join('nope').strpath, wheelhouse.strpath) == (0, 0)
+
+
+def test_venv_skeleton(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', tmpdir.strpath)
+    spec = {'python': ['2.7.6', '/usr'], 'system_site_packages': False, 'args': []}
+    created = []
+
+    def create(skeleton):
+        created.append(skeleton)
+        skeleton = Path(skeleton)
+        skeleton.ensure('bin/activate').write('VIRTUAL_ENV="%s"\n' % skeleton)
+        skeleton.ensure('bin/pip').write('#!%s/bin/python\n' % skeleton)
+        skeleton.ensure('lib/site-packages/paths.pth').write('%s/src\n' % skeleton)
+        skeleton.ensure('lib/site-packages/module.py').write('# built at %s\n' % skeleton)
+        skeleton.ensure('local', dir=True).join('bin').mksymlinkto(skeleton.join('bin'))
+
+    skeleton = venv_update.venv_skeleton(spec, create)
+    assert venv_update.venv_skeleton(spec, create) == skeleton
+    assert created == [skeleton]
+    assert venv_update.read_json(skeleton + '.json') == spec
+
+    venv = tmpdir.join('venv')
+    venv_update.venv_from_skeleton(venv.strpath, skeleton)
+    assert venv.join('bin/activate').read() == 'VIRTUAL_ENV="%s"\n' % venv
+    assert venv.join('bin/pip').read() == '#!%s/bin/python\n' % venv
+    assert venv.join('lib/site-packages/paths.pth').read() == '%s/src\n' % venv
+    assert venv.join('local/bin').realpath() == venv.join('bin')
+    # hardlinked, so it's left alone; the skeleton itself is unchanged
+    assert venv.join('lib/site-packages/module.py').read() == '# built at %s\n' % skeleton
+    assert Path(skeleton).join('bin/pip').read() == '#!%s/bin/python\n' % skeleton
+
+    # a skeleton that was never finished is made again
+    Path(skeleton + '.json').remove()
+    assert venv_update.venv_skeleton(spec, create) == skeleton
+    assert created == [skeleton, skeleton]
+
+
+def test_python_is_current(tmpdir):
+    import sys
+    assert venv_update.python_is_current(None) is True
+    assert venv_update.python_is_current(sys.executable) is True
+    assert venv_update.python_is_current(tmpdir.join('python').strpath) is False
+    assert venv_update.python_is_current('no-such-python') is False
+
+
+@pytest.mark.parametrize('code', [0, 2])
+def test_virtualenv_main_subprocess(monkeypatch, code):
+    class FakeVirtualenv(object):
+        @staticmethod
+        def main():
+            raise SystemExit(code)
+    monkeypatch.setattr(venv_update, 'import_virtualenv', lambda: FakeVirtualenv)
+
+    # virtualenv re-ran itself as a subprocess: that's done, unless it failed
+    if code:
+        with pytest.raises(SystemExit):
+            venv_update.virtualenv_main(('venv',))
+    else:
+        venv_update.virtualenv_main(('venv',))
@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 '''\
-usage: venv-update [-h] [virtualenv_dir] [requirements [requirements ...]]
+usage: venv-update [-h] [--batch=MANIFEST] [--jobs=N] [--transactional]
+                   [--events=FILE] [--compile=MODE] [--plan[=FILE]] [--collapse-cache]
+                   [--single-process] [--skeleton]
+                   [virtualenv_dir] [requirements [requirements ...]]
+       venv-update --warm-cache [--jobs=N] [--interpreters=PYTHON,...] [requirements [requirements ...]]
+       venv-update --tox=ENVDIR [pip install arguments ...]
 
 Update a (possibly non-existant) virtualenv directory using a requirements.txt listing
 When this script completes, the virtualenv should have the same packages as if it were
@@ -16,6 +21,52 @@ positional arguments:
 
 optional arguments:
   -h, --help      show this help message and exit
+  --batch=MANIFEST
+                  Update many virtualenvs at once. Each line of MANIFEST holds the
+                  arguments for one virtualenv: virtualenv_dir [requirements ...]
+                  Wheels are built once (per python), for all of them, then each
+                  virtualenv is updated in parallel. Not for use with --transactional.
+  --jobs=N        How many virtualenvs to update (or --warm-cache builds to run) at once.
+                  (default: number of cpus)
+  --transactional Update a (hardlinked) copy of the virtualenv, then swap it into place.
+                  If anything goes wrong, the original virtualenv is left as it was.
+  --events=FILE   Append a machine-readable record of the update to FILE, one json
+                  object per line: the start and end of each phase, and how long each
+                  package took to download, build and install (with sizes in bytes),
+                  and whether the download cache had it.
+  --compile=MODE  How to byte-compile the installed python files. By default, pip compiles
+                  each package, one at a time, as it's installed. Instead:
+                    parallel: compile every installed module, in parallel, after installing
+                    new: compile only the newly installed packages, in parallel
+                    lazy: don't compile; python writes the .pyc files as modules are imported
+  --plan[=FILE]   Don't change anything: show what an update would install, upgrade, downgrade
+                  and remove, as json (written to FILE, if given). Target versions come from
+                  the wheelhouse, so any requirement that isn't built yet is listed as unresolved.
+  --single-process
+                  Start python only once: create and relocate the virtualenv with virtualenv's
+                  own functions, then replace this process with the virtualenv's python, to
+                  install, rather than running each step as a separate python. Not for use with
+                  --batch or --transactional.
+  --skeleton      Create a new virtualenv by copying (mostly, hardlinking) a bare one, made
+                  once by virtualenv, with the same python and options, and kept in
+                  ~/.pip/venv-update. This saves most of the time virtualenv would take.
+  --warm-cache    Don't create or update any virtualenv: only build the wheels which are
+                  missing from the wheelhouse for these requirements files, in parallel.
+                  The current python needs pip and wheel installed.
+  --collapse-cache
+                  Once a download has been built into a wheel which suits every python, remove
+                  it from the download cache: the wheelhouse is all we need of it. Downloads which
+                  can't be built into such a wheel are kept.
+  --interpreters=PYTHON,...
+                  With --warm-cache: build the wheels for each of these pythons instead, in
+                  parallel. Each gets its own builder virtualenv, kept in ~/.pip/venv-update.
+  --tox=ENVDIR    Act as tox's install_command, in tox.ini:
+                      install_command = venv-update --tox={envdir} {opts} {packages}
+                  tox's deps are synced into its virtualenv (with anything extraneous removed),
+                  using the shared caches. Any other install, such as of the package itself
+                  (with --no-deps), goes straight to pip, which also uses the caches.
+
+Any other options are passed along to virtualenv.
 
 Version control at: https://github.com/yelp/venv-update
 '''
@@ -34,6 +85,68 @@ BOOTSTRAP_VERSIONS = (
 )
 
 
+# These options are for venv-update; all others are passed along to virtualenv.
+OPTIONS = (
+    'batch',
+    'jobs',
+    'transactional',
+    'events',
+    'warm-cache',
+    'interpreters',
+    'compile',
+    'plan',
+    'tox',
+    'collapse-cache',
+    'single-process',
+    'skeleton',
+    # internal-only: used to divide the work of a --batch among many stage2 processes
+    'build-only',
+    'no-build',
+    # internal-only: with --single-process, stage2 records the update's fingerprint for stage1
+    'last-update',
+    # internal-only: one of --warm-cache's parallel builds, of the requirements file given
+    'wheel-worker',
+)
+
+
+def parseopts(args):
+    """Separate venv-update's own --options from the rest of the arguments.
+
+    Returns a dictionary of the options, and the remaining arguments.
+    Flags given without a value are True.
+    """
+    options = {}
+    remaining = []
+    for arg in args:
+        name, equals, value = arg.partition('=')
+        if name.startswith('--') and name[2:] in OPTIONS:
+            options[name[2:]] = value if equals else True
+        else:
+            remaining.append(arg)
+    return options, tuple(remaining)
+
+
+# These options are passed along from stage1 to stage2.
+STAGE2_OPTIONS = ('compile', 'collapse-cache', 'no-build')
+
+
+def stage2_options(options):
+    return formatopts(dict(
+        (name, value) for name, value in options.items() if name in STAGE2_OPTIONS
+    ))
+
+
+def formatopts(options):
+    """The inverse of parseopts: a tuple of arguments which represent these options."""
+    result = []
+    for name, value in sorted(options.items()):
+        if value is True:
+            result.append('--' + name)
+        else:
+            result.append('--{0}={1}'.format(name, value))
+    return tuple(result)
+
+
 def parseargs(args):
     if set(args) & set(('-h', '--help')):
         print(__doc__, end='')
@@ -93,10 +206,107 @@ def colorize(cmd):
 
 def run(cmd):
     from subprocess import check_call
-    check_call(('echo', colorize(cmd)))
+    from sys import stdout
+    print(colorize(cmd))
+    stdout.flush()
     check_call(cmd)
 
 
+# Both stages (and any other venv-update subprocesses) append --events to the file named here.
+EVENTS_ENVIRON = 'VENV_UPDATE_EVENTS'
+
+
+def event(kind, **fields):
+    """Record one event, as a line of json, to the --events file (if there is one).
+
+    Each line is written with a single O_APPEND write, so concurrent processes don't garble each other.
+    """
+    from os import environ
+    events_path = environ.get(EVENTS_ENVIRON)
+    if not events_path:
+        return
+
+    import os
+    from json import dumps
+    from time import time
+    fields.update(event=kind, time=time(), pid=os.getpid())
+    line = (dumps(fields, sort_keys=True) + '\n').encode('UTF-8')
+    events_file = os.open(events_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+    try:
+        os.write(events_file, line)
+    finally:
+        os.close(events_file)
+
+
+@contextmanager
+def timed_event(kind, **fields):
+    """Record an event once this block is done, with its duration in seconds and whether it succeeded.
+
+    Yields the event's fields, so that the block can add to them.
+    """
+    from time import time
+    start = time()
+    success = False
+    try:
+        yield fields
+        success = True
+    finally:
+        fields.setdefault('success', success)
+        event(kind, seconds=time() - start, **fields)
+
+
+@contextmanager
+def phase(name):
+    """Record the start and end of one phase of the update."""
+    event('phase-start', phase=name)
+    with timed_event('phase-end', phase=name):
+        yield
+
+
+def run_parallel(cmds, jobs):
+    """Run each of these commands, with at most `jobs` of them running at once.
+
+    Each command's output is saved, then shown all together once it finishes.
+    Returns the commands' exit codes, in order.
+    """
+    from subprocess import Popen, STDOUT
+    from tempfile import TemporaryFile
+    from time import sleep
+
+    pending = list(enumerate(cmds))
+    running = []
+    returncodes = [None] * len(pending)
+    while pending or running:
+        while pending and len(running) < jobs:
+            index, cmd = pending.pop(0)
+            output = TemporaryFile()
+            running.append((index, cmd, output, Popen(cmd, stdout=output, stderr=STDOUT)))
+
+        for job in tuple(running):
+            index, cmd, output, process = job
+            if process.poll() is None:
+                continue
+            running.remove(job)
+            returncodes[index] = process.returncode
+            show_output(cmd, output)
+        sleep(0.05)
+
+    return returncodes
+
+
+def show_output(cmd, output):
+    """Show a finished command, then the output it saved to this file (which is closed afterward)."""
+    from sys import stdout
+    stdout_bytes = getattr(stdout, 'buffer', stdout)
+
+    output.seek(0)
+    stdout.write(colorize(cmd) + '\n')
+    stdout.flush()
+    stdout_bytes.write(output.read())
+    stdout_bytes.flush()
+    output.close()
+
+
 def req_is_absolute(requirement):
     if not requirement:
         # url-style requirement
@@ -108,13 +318,67 @@ def req_is_absolute(requirement):
     return False
 
 
+# How often each cache saved us some work, this run: (cache, outcome, reason) -> count
+CACHE_COUNTERS = {}
+
+
+def count_cache(cache, outcome, reason=''):
+    key = (cache, outcome, reason)
+    CACHE_COUNTERS[key] = CACHE_COUNTERS.get(key, 0) + 1
+
+
+def report_cache_counters():
+    """Show (and record, to --events) how effective the caches were."""
+    if not CACHE_COUNTERS:
+        return
+
+    counters = {}
+    for (cache, outcome, reason), count in sorted(CACHE_COUNTERS.items()):
+        label = '{0} {1}'.format(cache, outcome)
+        if reason:
+            label += ' ({0})'.format(reason)
+        counters[label] = count
+    event('cache-counters', counters=counters)
+
+    print('Cache counters:')
+    for label, count in sorted(counters.items()):
+        print('  {0}: {1}'.format(label, count))
+
+
+def wheelhouse_versions(wheel_dir, name):
+    """Yield the (path, version) of each of this project's wheels in wheel_dir which this python supports.
+
+    Many interpreters can share the wheelhouse, so it may have others' wheels too (see --interpreters).
+    """
+    from os.path import basename, join
+    from glob import glob
+    from pip.wheel import Wheel
+    # this matches the name-munging done in pip.wheel:
+    reqname = name.replace('-', '_')
+    for path in glob(join(wheel_dir, reqname + '-*.whl')):
+        wheel = Wheel(basename(path))
+        if wheel.supported():
+            yield path, wheel.version
+
+
+def wheel_is_built(wheel_dir, requirement):
+    """Is this (pkg_resources) requirement pinned down, with a matching wheel in wheel_dir?"""
+    return req_is_absolute(requirement) and any(
+        version in requirement
+        for dummy_path, version in wheelhouse_versions(wheel_dir, requirement.project_name)
+    )
+
+
 def faster_find_requirement(self, req, upgrade):
     """see faster_pip_packagefinder"""
     from pip.index import BestVersionAlreadyInstalled
-    if req_is_absolute(req.req):
+    if not req_is_absolute(req.req):
+        count_cache('fast-path', 'miss', 'unpinned')
+    else:
         # if the version is pinned-down by a ==
         # first try to use any installed packge that satisfies the req
         if req.satisfied_by:
+            count_cache('fast-path', 'hit', 'installed')
             if upgrade:
                 # as a matter of api, find_requirement() only raises during upgrade -- shrug
                 raise BestVersionAlreadyInstalled
@@ -122,22 +386,23 @@ def faster_find_requirement(self, req, upgrade):
                 return None
 
         # then try an optimistic search for a .whl file:
-        from os.path import join
-        from glob import glob
-        from pip.wheel import Wheel
         from pip.index import Link
+        # if another venv-update is building this very wheel, wait for it to finish
+        for qualifier, version in req.req.specs:
+            if qualifier == '==':
+                wait_for_lock(artifact_lock_path(wheel_artifact(req.name, version)))
+        reason = 'not in wheelhouse'
         for findlink in self.find_links:
             if findlink.startswith('file://'):
                 findlink = findlink[7:]
             else:
                 continue
-            # this matches the name-munging done in pip.wheel:
-            reqname = req.name.replace('-', '_')
-            for link in glob(join(findlink, reqname + '-*.whl')):
-                link = Link('file://' + link)
-                wheel = Wheel(link.filename)
-                if wheel.version in req.req:
-                    return link
+            for path, version in wheelhouse_versions(findlink, req.name):
+                if version in req.req:
+                    count_cache('fast-path', 'hit', 'wheelhouse')
+                    return Link('file://' + path)
+                reason = 'version mismatch'
+        count_cache('fast-path', 'miss', reason)
 
     # otherwise, do the full network search
     return self.unpatched['find_requirement'](self, req, upgrade)
@@ -162,6 +427,342 @@ def faster_pip_packagefinder():
         del PackageFinder.unpatched
 
 
+def url_size(url):
+    """The size of a file:// url, else None."""
+    from os.path import getsize
+    if url.startswith('file://'):
+        from pip.download import url_to_path
+        return getsize(url_to_path(url))
+
+
+@contextmanager
+def pip_events():
+    """Record --events for each package that pip downloads, builds, or installs."""
+    from os import environ
+    if not environ.get(EVENTS_ENVIRON):
+        yield
+        return
+
+    # pylint:disable=protected-access
+    from pip import download as pip_download
+    from pip.req import InstallRequirement
+    from pip.wheel import WheelBuilder
+
+    unpatched = {
+        '_download_url': pip_download._download_url,
+        '_build_one': WheelBuilder._build_one,
+        'install': InstallRequirement.install,
+    }
+
+    def _download_url(resp, link, temp_location):
+        from os.path import getsize
+        with timed_event('download', url=link.url_without_fragment) as fields:
+            result = unpatched['_download_url'](resp, link, temp_location)
+            fields['bytes'] = getsize(temp_location)
+        return result
+
+    def _build_one(self, req):
+        from os import listdir
+        from os.path import getsize, join
+        before = set(listdir(self.wheel_dir))
+        with timed_event('build', name=req.name) as fields:
+            fields['success'] = success = unpatched['_build_one'](self, req)
+            fields['bytes'] = sum(
+                getsize(join(self.wheel_dir, wheel))
+                for wheel in set(listdir(self.wheel_dir)) - before
+            )
+        return success
+
+    def install(self, *args, **kwargs):
+        with timed_event('install', name=self.name, editable=self.editable) as fields:
+            if self.url and not self.editable:
+                fields['bytes'] = url_size(self.url.split('#', 1)[0])
+            return unpatched['install'](self, *args, **kwargs)
+
+    pip_download._download_url = _download_url
+    WheelBuilder._build_one = _build_one
+    InstallRequirement.install = install
+    try:
+        yield
+    finally:
+        pip_download._download_url = unpatched['_download_url']
+        WheelBuilder._build_one = unpatched['_build_one']
+        InstallRequirement.install = unpatched['install']
+
+
+# The wheels built this run, by the url of the requirement each was built for: {url: [wheel path, ...]}
+BUILT_WHEELS = {}
+
+
+@contextmanager
+def shared_caches():
+    """Make pip safe to run in many processes at once, against the same wheelhouse and download cache.
+
+    Each download and each wheel build happens under its own lock, so that a second process waits for
+    the first, then uses its result. Artifacts are renamed into place, so they're never seen half-written.
+    Download-cache hits and misses are counted along the way.
+    """
+    # A poor man's dependency injection: monkeypatch :(
+    # pylint:disable=protected-access
+    from pip import download as pip_download, req as pip_req
+    from pip.backwardcompat import urllib
+    from pip.log import logger
+    from pip.wheel import WheelBuilder
+
+    unpatched = {
+        'unpack_http_url': pip_req.unpack_http_url,
+        'cache_download': pip_download.cache_download,
+        '_build_one': WheelBuilder._build_one,
+    }
+
+    def unpack_http_url(link, location, download_cache, *args, **kwargs):
+        if not download_cache:
+            return unpatched['unpack_http_url'](link, location, download_cache, *args, **kwargs)
+
+        from os.path import exists, join
+        url = link.url_without_fragment
+        with file_lock(artifact_lock_path('download:' + url)):
+            # this matches the name-munging done in pip.download:
+            cache_file = join(download_cache, urllib.quote(url, ''))
+            hit = exists(cache_file) and exists(cache_file + '.content-type')
+            count_cache('download-cache', 'hit' if hit else 'miss')
+            event('download-cache', url=url, hit=hit)
+            return unpatched['unpack_http_url'](link, location, download_cache, *args, **kwargs)
+
+    def cache_download(target_file, temp_location, content_type):
+        from shutil import copyfileobj
+        logger.notify('Storing download in cache at %s' % target_file)
+        with atomic_file(target_file) as cached:
+            with open(temp_location, 'rb') as downloaded:
+                copyfileobj(downloaded, cached)
+        write_atomically(target_file + '.content-type', content_type.encode('UTF-8'))
+
+    def _build_one(self, req):
+        from os import listdir, rename
+        from os.path import join
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        from pip._vendor.pkg_resources import Requirement
+
+        version = req.installed_version
+        with file_lock(artifact_lock_path(wheel_artifact(req.name, version))):
+            # another process may have built it, while we waited (though a vcs requirement's version may
+            # well be the same, commit after commit)
+            if (
+                    not (req.url or '').startswith(VCS_SCHEMES) and
+                    wheel_is_built(self.wheel_dir, Requirement.parse('{0}=={1}'.format(req.name, version)))
+            ):
+                logger.notify('Skipping %s, due to already being built' % req.name)
+                return True
+
+            # build off to the side, so that the wheelhouse never has a partial wheel
+            wheel_dir = self.wheel_dir
+            mkdirp(wheel_dir)
+            self.wheel_dir = mkdtemp(dir=wheel_dir, prefix='.build-')
+            try:
+                success = unpatched['_build_one'](self, req)
+                for wheel in listdir(self.wheel_dir):
+                    rename(join(self.wheel_dir, wheel), join(wheel_dir, wheel))
+                    wheel_sidecar(join(wheel_dir, wheel), added=True)
+                    BUILT_WHEELS.setdefault(req.url, []).append(join(wheel_dir, wheel))
+            finally:
+                rmtree(self.wheel_dir)
+                self.wheel_dir = wheel_dir
+        return success
+
+    pip_req.unpack_http_url = unpack_http_url
+    pip_download.cache_download = cache_download
+    WheelBuilder._build_one = _build_one
+    try:
+        yield
+    finally:
+        pip_req.unpack_http_url = unpatched['unpack_http_url']
+        pip_download.cache_download = unpatched['cache_download']
+        WheelBuilder._build_one = unpatched['_build_one']
+
+
+# Members are copied, or inflated, this many (compressed) bytes at a time.
+UNPACK_BLOCK_SIZE = 1 << 20
+
+
+def write_all(fd, data):
+    from os import write
+    while data:
+        data = data[write(fd, data):]
+
+
+def copy_range(source_map, dest_fd, offset, size):
+    """Write one stored zip member to dest, straight from the mmap of the archive, in large blocks.
+    Returns its CRC-32, computed in the same pass.
+    """
+    import zlib
+    end = offset + size
+    if end > len(source_map):
+        from zipfile import BadZipfile
+        raise BadZipfile('Truncated member at offset %i' % offset)
+    crc = 0
+    for start in range(offset, end, UNPACK_BLOCK_SIZE):
+        data = source_map[start:min(end, start + UNPACK_BLOCK_SIZE)]
+        crc = zlib.crc32(data, crc)
+        write_all(dest_fd, data)
+    return crc & 0xffffffff
+
+
+def inflate_range(source_map, dest_fd, offset, compressed_size):
+    """Decompress one deflated zip member, in large blocks. Returns its CRC-32."""
+    import zlib
+    inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+    crc = 0
+    end = offset + compressed_size
+    for start in range(offset, end, UNPACK_BLOCK_SIZE):
+        data = inflater.decompress(source_map[start:min(end, start + UNPACK_BLOCK_SIZE)])
+        crc = zlib.crc32(data, crc)
+        write_all(dest_fd, data)
+    data = inflater.flush()
+    crc = zlib.crc32(data, crc)
+    write_all(dest_fd, data)
+    return crc & 0xffffffff
+
+
+def member_path(filename, location, name):
+    """Where a wheel's member goes, within `location`. A path which would escape it is refused."""
+    import os
+    from zipfile import BadZipfile
+    parts = name.replace('\\', '/').split('/')
+    if name.startswith(('/', '\\')) or '..' in parts:
+        raise BadZipfile('Unsafe path in %s: %r' % (filename, name))
+    return os.path.join(location, *parts)
+
+
+def member_offset(filename, archive_map, info):
+    """Where a member's data starts: after its local header, which is 30 bytes, then a name and "extra" field."""
+    import struct
+    from zipfile import BadZipfile
+    header = archive_map[info.header_offset:info.header_offset + 30]
+    if len(header) < 30 or header[:4] != b'PK\x03\x04':
+        raise BadZipfile('Bad local file header for %r in %s' % (info.filename, filename))
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    return info.header_offset + 30 + name_length + extra_length
+
+
+def unpack_member(archive, archive_map, info, dest):
+    """Write one (file) member of the archive to `dest`, checking its CRC-32."""
+    import os
+    import zipfile
+    offset = member_offset(archive.name, archive_map, info)
+    dest_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        if info.compress_type == zipfile.ZIP_STORED:
+            crc = copy_range(archive_map, dest_fd, offset, info.file_size)
+        elif info.compress_type == zipfile.ZIP_DEFLATED:
+            crc = inflate_range(archive_map, dest_fd, offset, info.compress_size)
+        else:  # some rarer compression: let zipfile handle it (and check it)
+            write_all(dest_fd, zipfile.ZipFile(archive).read(info))
+            crc = info.CRC
+    finally:
+        os.close(dest_fd)
+    if crc != info.CRC:
+        raise zipfile.BadZipfile('Bad CRC-32 for %r in %s' % (info.filename, archive.name))
+
+
+def unpack_wheel(filename, location):
+    """Unpack a wheel archive to `location`, the same as pip does, with a good deal less copying.
+
+    Stored members are written straight from an mmap of the archive, and deflated members are inflated from it,
+    in large blocks, each checked against its CRC-32 in the same pass. As in pip, a member with any execute
+    permission is made executable.
+    """
+    import os
+    import stat
+    import zipfile
+    from mmap import mmap, ACCESS_READ
+
+    umask = os.umask(0)
+    os.umask(umask)
+
+    with open(filename, 'rb') as archive:
+        infolist = zipfile.ZipFile(archive).infolist()
+        archive_map = mmap(archive.fileno(), 0, access=ACCESS_READ)
+        try:
+            for info in infolist:
+                dest = member_path(filename, location, info.filename)
+                if info.filename.endswith(('/', '\\')):  # a directory
+                    mkdirp(dest)
+                    continue
+                mkdirp(os.path.dirname(dest))
+                unpack_member(archive, archive_map, info, dest)
+
+                mode = info.external_attr >> 16
+                if mode and stat.S_ISREG(mode) and mode & 0o111:
+                    os.chmod(dest, (0o777 & ~umask) | 0o111)
+        finally:
+            archive_map.close()
+
+
+def move_file(source, dest):
+    """Move a file, as shutil.copy2 would copy it: by a rename, unless that would cross filesystems."""
+    from errno import EXDEV
+    from os import rename
+    from shutil import copy2
+    try:
+        rename(source, dest)
+    except OSError as error:
+        if error.errno != EXDEV:
+            raise
+        copy2(source, dest)
+
+
+def moving_shutil():
+    """A stand-in for the shutil module, whose copy2 moves the file instead (see move_file)."""
+    import shutil
+    from types import ModuleType
+    module = ModuleType(str('shutil'))
+    module.__dict__.update(vars(shutil))
+    module.copy2 = move_file
+    return module
+
+
+@contextmanager
+def faster_wheel_unpacking():
+    """Have pip unpack wheels with unpack_wheel, rather than reading each member into memory with zipfile.
+
+    pip then copies each unpacked file to where it's installed (and removes the unpacked copy).
+    Since the unpacked wheel is pip's own, temporary, copy, we have pip move the files instead: a rename.
+    """
+    from pip import util as pip_util, wheel as pip_wheel
+    unpatched_unzip_file = pip_util.unzip_file
+    unpatched_shutil = pip_wheel.shutil
+
+    def unzip_file(filename, location, flatten=True):
+        from os.path import dirname, isdir, join
+        if filename.endswith('.whl') and not flatten:
+            # the wheelhouse is indexed, and so its wheels can be verified
+            if isdir(join(dirname(filename), '.index')):
+                verify_wheel(filename)
+            unpack_wheel(filename, location)
+        else:
+            unpatched_unzip_file(filename, location, flatten)
+
+    # A poor man's dependency injection: monkeypatch :(
+    pip_util.unzip_file = unzip_file
+    pip_wheel.shutil = moving_shutil()
+    try:
+        yield
+    finally:
+        pip_util.unzip_file = unpatched_unzip_file
+        pip_wheel.shutil = unpatched_shutil
+
+
+@contextmanager
+def patched_pip():
+    """All of our improvements to pip, together."""
+    with faster_pip_packagefinder():
+        with shared_caches():
+            with faster_wheel_unpacking():
+                with pip_events():
+                    yield
+
+
 def pip(args):
     """Run pip, in-process."""
     import pip as pipmodule
@@ -174,7 +775,7 @@ def pip(args):
     stdout.write('\n')
     stdout.flush()
 
-    with faster_pip_packagefinder():
+    with patched_pip():
         result = pipmodule.main(list(args))
 
     if result != 0:
@@ -182,21 +783,77 @@ def pip(args):
         exit(result)
 
 
-def dist_to_req(dist):
-    """Make a pip.FrozenRequirement from a pkg_resources distribution object"""
-    from pip import FrozenRequirement
+class InstalledDist(object):
+    """A compact record of an installed distribution: all we need to know, to work out what to (un)install.
 
-    # normalize the casing, dashes in the req name
-    orig_name, dist.project_name = dist.project_name, dist.key
-    result = FrozenRequirement.from_dist(dist, [])
-    # put things back the way we found it.
-    dist.project_name = orig_name
+    venv-update compares hundreds of these per update, so they're kept small and cheap to make.
+    """
+    __slots__ = ('name', 'version', 'location', 'editable')
 
-    return result
+    def __init__(self, name, version, location, editable):
+        self.name = name  # normalized: the pkg_resources key
+        self.version = version
+        self.location = location
+        self.editable = editable
+
+    @classmethod
+    def from_dist(cls, dist):
+        """Summarize a pkg_resources distribution."""
+        from pip.vcs import vcs
+        # this is pip's test, without asking the vcs for the requirement
+        editable = vcs.get_backend_name(dist.location) is not None
+        return cls(dist.key, dist.version, dist.location, editable)
+
+    @classmethod
+    def from_index(cls, entry):
+        """Load an entry of the installed index (see installed_index)."""
+        return cls(entry['name'], entry['version'], entry['location'], entry['editable'])
+
+    def __repr__(self):
+        return '<{0} {1}=={2}{3}>'.format(
+            type(self).__name__, self.name, self.version, ' (editable)' if self.editable else '',
+        )
 
 
 def pip_get_installed():
-    """Code extracted from the middle of the pip freeze command.
+    """The local, installed distributions, as InstalledDist records, answered from the installed index."""
+    return tuple(InstalledDist.from_index(dist) for dist in installed_index().values())
+
+
+def running_under_virtualenv():
+    import sys
+    return hasattr(sys, 'real_prefix')
+
+
+def path_mtimes(paths):
+    from os.path import getmtime
+    result = {}
+    for path in paths:
+        try:
+            result[path] = getmtime(path)
+        except OSError:
+            result[path] = None
+    return result
+
+
+def index_dist(dist):
+    """Summarize an installed distribution for the installed index."""
+    record = InstalledDist.from_dist(dist)
+    return {
+        'name': record.name,  # normalized: the pkg_resources key
+        'version': record.version,
+        'location': record.location,
+        'requires': [str(req) for req in dist.requires()],
+        'editable': record.editable,
+    }
+
+
+def installed_index(updated=(), save=True):
+    """An index of the local, installed distributions: {key: {name, version, location, requires, editable}}
+
+    The index is kept in the virtualenv, and only rebuilt (by scanning every distribution's metadata) when the
+    modification times of the sys.path directories show that something was installed or removed since.
+    `updated` names projects which venv-update has just (un)installed: just these are re-indexed.
     """
     if True:
         # pragma:no cover:pylint:disable=no-name-in-module,import-error
@@ -205,12 +862,36 @@ def pip_get_installed():
         except ImportError:
             # pip < 6.0
             from pip.util import dist_is_local
+    from sys import path, prefix
+    from pip._vendor.pkg_resources import safe_name
 
-    return tuple(
-        dist_to_req(dist)
-        for dist in fresh_working_set()
-        if dist_is_local(dist)
-    )
+    # only the local distributions are indexed, so only local directories matter
+    local_paths = [entry for entry in path if path_is_within(entry, prefix)]
+    index_path = venv_state_path(prefix, 'installed.json')
+    index = read_json(index_path) if running_under_virtualenv() else None
+    if index is not None and not updated and index['paths'] == path_mtimes(local_paths):
+        return index['dists']
+
+    working_set = fresh_working_set()
+    if index is None or not updated:
+        dists = dict(
+            (dist.key, index_dist(dist))
+            for dist in working_set
+            if dist_is_local(dist)
+        )
+    else:
+        dists = index['dists']
+        for name in updated:
+            key = safe_name(name).lower()
+            dist = working_set.by_key.get(key)
+            if dist is not None and dist_is_local(dist):
+                dists[key] = index_dist(dist)
+            else:
+                dists.pop(key, None)
+
+    if save and running_under_virtualenv():
+        write_json(index_path, {'paths': path_mtimes(local_paths), 'dists': dists})
+    return dists
 
 
 def pip_parse_requirements(requirement_files):
@@ -224,6 +905,163 @@ def pip_parse_requirements(requirement_files):
     return required
 
 
+def requirements_fingerprint(requirement_files):
+    """A hash of everything these requirements files say, including the files they include.
+
+    Comments and blank lines don't count. Relative paths in requirements are relative to the working directory,
+    so that counts too.
+    """
+    from hashlib import sha256
+    from os import getcwd
+    from os.path import abspath
+
+    fingerprint = sha256(getcwd().encode('UTF-8'))
+    for filename, line in requirements_lines(requirement_files):
+        fingerprint.update(b'\0' + abspath(filename).encode('UTF-8'))
+        fingerprint.update(b'\0' + line.encode('UTF-8'))
+    return fingerprint.hexdigest()
+
+
+def cached_parse_requirements(requirement_files):
+    """Same as pip_parse_requirements, but cached according to the requirements_fingerprint.
+
+    Only the newest parse of the same requirements files (from the same working directory) is kept.
+    """
+    import pickle
+    from os import getcwd
+    from os.path import abspath
+    from sys import version
+    from pip import __version__ as pip_version
+
+    try:
+        fingerprint = requirements_fingerprint(requirement_files)
+    except (IOError, OSError):
+        # let pip give its usual error message
+        return pip_parse_requirements(requirement_files)
+
+    # a pickle is only good for the same versions of python and pip
+    owner = sha256hex('\0'.join([getcwd()] + [abspath(filename) for filename in requirement_files]))
+    interpreter = sha256hex(version + pip_version)
+    cachefile = cache_path('requirements', '{0}-{1}-{2}.pickle'.format(owner, fingerprint, interpreter))
+    try:
+        with open(cachefile, 'rb') as cached:
+            return pickle.load(cached)
+    except (IOError, EOFError, pickle.UnpicklingError, ValueError, KeyError):
+        # a missing, or corrupt cache: either way we start over. (python2's pickle raises KeyError for a bad opcode.)
+        pass
+
+    required = pip_parse_requirements(requirement_files)
+    try:
+        write_atomically(cachefile, pickle.dumps(required, pickle.HIGHEST_PROTOCOL))
+    except (IOError, OSError, pickle.PicklingError, TypeError, AttributeError):
+        pass  # the cache is only an optimization; no harm done
+    else:
+        # the requirements have changed since those were written
+        remove_superseded(cache_path('requirements', '{0}-*-{1}.pickle'.format(owner, interpreter)), cachefile)
+    return required
+
+
+def remove_superseded(pattern, newest):
+    """Remove each file matching this glob pattern, except the newest one, which supersedes them."""
+    from glob import glob
+    from os import unlink
+    for path in glob(pattern):
+        if path != newest:
+            try:
+                unlink(path)
+            except OSError:
+                pass  # another process beat us to it
+
+
+def requirements_lines(requirement_files, seen=None):
+    """Yield (filename, line) for each meaningful line of these requirements files.
+
+    Nested `-r` includes are followed in place, the same as pip does, but each file is read just once.
+    """
+    from os.path import dirname, join, normpath
+    from re import sub
+
+    if seen is None:
+        seen = set()
+
+    for filename in requirement_files:
+        filename = normpath(filename)
+        if filename in seen:
+            continue
+        seen.add(filename)
+
+        with open(filename) as reqfile:
+            lines = reqfile.readlines()
+
+        for line in lines:
+            line = sub(r'(^|\s)#.*$', '', line.strip()).strip()
+            if not line:
+                continue
+            elif line.startswith('-r'):
+                include = line[2:].strip()
+            elif line.startswith('--requirement'):
+                include = line[len('--requirement'):].strip().strip('=')
+            else:
+                yield filename, line
+                continue
+
+            for item in requirements_lines((join(dirname(filename), include),), seen):
+                yield item
+
+
+# requirements-file options which name a requirement; every other option (-i, -f, --allow-external, ...)
+#   applies to the requirements file as a whole
+REQUIREMENT_OPTIONS = ('-e', '--editable')
+
+
+def pip_options(requirement_files):
+    """The options given in these requirements files, such as where packages are found, and which are allowed.
+    Any requirements file we write in their place needs the same.
+    """
+    result = []
+    for dummy_filename, line in requirements_lines(requirement_files):
+        if line.startswith('-') and not line.startswith(REQUIREMENT_OPTIONS) and line not in result:
+            result.append(line)
+    return result
+
+
+def requirement_line(req):
+    """Turn a pip InstallRequirement back into a line of a requirements file."""
+    if req.editable:
+        return '-e ' + req.url
+    elif req.url:
+        return req.url
+    else:
+        return str(req.req)
+
+
+def requirement_rounds(requirements):
+    """Divide the union of these requirements into as few rounds as possible, where no project is named twice
+    within a round, since pip refuses a "Double requirement". Each distinct requirement appears just once.
+    """
+    rounds = []
+    seen = set()
+    for req in requirements:
+        line = requirement_line(req)
+        if line in seen:
+            continue
+        seen.add(line)
+
+        name = req.name and req.name.lower()
+        for names, lines in rounds:
+            if name is None or name not in names:
+                break
+        else:
+            names, lines = set(), []
+            rounds.append((names, lines))
+
+        if name is not None:
+            names.add(name)
+        lines.append(line)
+
+    return [lines for dummy_names, lines in rounds]
+
+
 def importlib_invalidate_caches():
     """importlib.invalidate_caches is necessary if anything has been installed after python startup.
     New in python3.3.
@@ -283,106 +1121,756 @@ def fresh_working_set():
     return WorkingSetPlusEditableInstalls()
 
 
-def trace_requirements(requirements):
-    """given an iterable of pip InstallRequirements,
-    return the set of required packages, given their transitive requirements.
-    """
-    from collections import deque
-    from pip import logger
-    from pip.req import InstallRequirement
-    from pip._vendor import pkg_resources
+class DependencyGraph(object):  # pylint:disable=too-many-instance-attributes
+    """The transitive requirements of a set of requirements.
 
-    working_set = fresh_working_set()
+    Each project is looked up, and has its requirements expanded, just once (plus once per newly-requested extra),
+    so building the graph takes time and memory linear in its size.
+    Version conflicts and unmet requirements are noted, rather than raised, for the caller to decide about.
 
-    # breadth-first traversal:
-    queue = deque(requirements)
-    result = []
-    seen_warnings = set()
-    while queue:
-        req = queue.popleft()
-        if req.req is None:
-            # a file:/// requirement
-            continue
+    `lookup` maps a requirement to the pkg_resources-like distribution which would fulfill it (even if it's the
+    wrong version), or None if there's none available.
+    """
+
+    def __init__(self, lookup):
+        self.lookup = lookup
+        self.order = []  # project keys, in the order they were found
+        self.nodes = {}  # project key -> distribution
+        self.edges = {}  # project key -> the keys of its requirements, in order
+        self.required_as = {}  # project key -> how we first came to require it, for messages
+        self.conflicts = []  # (requirement, distribution, description of the requirement)
+        self.missing = []  # (requirement, description of the requirement)
+        self.roots = []
+        self._extras = {}  # project key -> the extras expanded so far
+        self._seen = set()  # (parent key, requirement) pairs: every edge is considered once
+
+    def add(self, requirements):
+        """Add these pip InstallRequirements, and everything they require, to the graph."""
+        from collections import deque
+
+        # breadth-first traversal:
+        queue = deque(
+            (req.req, None, str(req))
+            for req in requirements
+            if req.req is not None  # a file:/// requirement
+        )
+        while queue:
+            req, parent, description = queue.popleft()
+            if (parent, req) in self._seen:
+                continue
+            self._seen.add((parent, req))
+
+            key = req.key
+            dist = self.nodes.get(key)
+            if dist is None:
+                dist = self.lookup(req)
+                if dist is None:
+                    self.missing.append((req, description))
+                    continue
+                self.order.append(key)
+                self.nodes[key] = dist
+                self.edges[key] = []
+                self.required_as[key] = description
+                self._extras[key] = None
+
+            if parent is None:
+                if key not in self.roots:
+                    self.roots.append(key)
+            elif key not in self.edges[parent]:
+                self.edges[parent].append(key)
+
+            if dist not in req:
+                self.conflicts.append((req, dist, description))
+
+            queue.extend(
+                (dist_req, key, '{0} (from {1})'.format(dist_req, self.required_as[key]))
+                for dist_req in self._expand(key, dist, req.extras)
+            )
+
+        return self
+
+    def _expand(self, key, dist, extras):
+        """The requirements of a distribution which haven't been expanded yet, given these extras."""
+        from pip._vendor.pkg_resources import UnknownExtra
+
+        expanded = self._extras[key]
+        if expanded is None:
+            expanded = self._extras[key] = set()
+            new_extras = set(extras)
+        else:
+            new_extras = set(extras) - expanded
+            if not new_extras:
+                return ()
+        expanded.update(new_extras)
 
         try:
-            dist = working_set.find(req.req)
-        except pkg_resources.VersionConflict as conflict:
-            # TODO: This should really be an error, but throw a warning for now, while we integrate.
-            # TODO: test case, eg: install pylint, install old astroid, update
-            #       astroid should still be installed after
-            dist = conflict.args[0]
-            if req.name not in seen_warnings:
-                logger.warn("Warning: version conflict: %s <-> %s", dist, req)
-                seen_warnings.add(req.name)
-
-        if dist is None:
-            # TODO: test case, eg: install pylint, uninstall astroid, update
-            #       -> Unmet dependency: astroid>=1.3.2 (from pylint (from -r faster.txt (line 4)))
-            logger.error('Unmet dependency: %s', req)
-            exit(1)
-
-        result.append(dist_to_req(dist))
-
-        for dist_req in dist.requires():  # should we support extras?
-            # there really shouldn't be any circular dependencies...
-            queue.append(InstallRequirement(dist_req, str(req)))
+            # pkg_resources evaluates the environment markers for us, here.
+            return dist.requires(sorted(new_extras))
+        except UnknownExtra as error:
+            from pip import logger
+            logger.warn('Warning: %s', error)
+            return dist.requires()
+
+    def cycles(self):
+        """Find each circular dependency, as a list of project keys, where the last requires the first."""
+        result = []
+        # iterative depth-first search, colored: absent=unvisited, False=in progress, True=done
+        color = {}
+        for root in self.order:
+            if root in color:
+                continue
+            color[root] = False
+            path = [root]
+            stack = [iter(self.edges[root])]
+            while stack:
+                for child in stack[-1]:
+                    if child not in color:
+                        color[child] = False
+                        path.append(child)
+                        stack.append(iter(self.edges[child]))
+                        break
+                    elif color[child] is False:
+                        result.append(path[path.index(child):])
+                else:
+                    color[path.pop()] = True
+                    stack.pop()
+        return result
 
-    return result
+    def install_order(self):
+        """Project keys, ordered such that each one comes after its requirements (except where there are cycles)."""
+        result = []
+        done = set()
+        for root in self.roots + self.order:
+            if root in done:
+                continue
+            done.add(root)
+            path = [root]
+            stack = [iter(self.edges[root])]
+            while stack:
+                for child in stack[-1]:
+                    if child not in done:
+                        done.add(child)
+                        path.append(child)
+                        stack.append(iter(self.edges[child]))
+                        break
+                else:
+                    result.append(path.pop())
+                    stack.pop()
+        return result
 
 
-def reqnames(reqs):
-    return set(req.name for req in reqs)
+def installed_dependency_graph(requirements):
+    """The dependency graph of these pip InstallRequirements, according to what's currently installed."""
+    by_key = fresh_working_set().by_key
+    return DependencyGraph(lambda req: by_key.get(req.key)).add(requirements)
 
 
-def path_is_within(path, within):
-    from os.path import relpath, join
-    path = join('.', path)  # eliminate empty-string edge case
-    return not relpath(path, within).startswith('..')
+def wheel_tags(filename):
+    """The (python, abi, platform) tags of a wheel, from its filename. Each part may be a '.'-separated set."""
+    pythons, abis, platforms = filename[:-len('.whl')].split('-')[-3:]
+    return [
+        [python, abi, platform]
+        for python in pythons.split('.')
+        for abi in abis.split('.')
+        for platform in platforms.split('.')
+    ]
 
 
-@contextmanager
-def venv(venv_path, venv_args):
-    """Ensure we have a virtualenv."""
-    from sys import executable
-    virtualenv = (executable, '-m', 'virtualenv', venv_path)
+def read_wheel_metadata(wheel_path):
+    """The METADATA of a wheel, parsed. Returns an email.message.Message."""
+    from email.parser import Parser
+    from zipfile import ZipFile, BadZipfile
+    archive = ZipFile(wheel_path)
+    try:
+        for name in archive.namelist():
+            if name.count('/') == 1 and name.endswith('.dist-info/METADATA'):
+                return Parser().parsestr(archive.read(name).decode('UTF-8'))
+    finally:
+        archive.close()
+    raise BadZipfile('No .dist-info/METADATA in ' + wheel_path)
 
-    from os.path import exists, join
-    if exists(join(venv_path, 'bin', 'python')):
-        # already done!
-        # TODO: keep a hash of venv_args, to make this reliable
-        #   on hash diff, rm -rf (worst case: -p pypy -> -p py34)
-        pass
-    else:
-        run(virtualenv + venv_args)
 
-    yield
+def split_marker(requires_dist):
+    """Split a Requires-Dist into [requirement, environment marker (or None)]."""
+    requirement, dummy_semicolon, marker = requires_dist.partition(';')
+    return [requirement.strip(), marker.strip() or None]
 
-    # Postprocess: Make our venv relocatable, since we do plan to relocate it, sometimes.
-    run(
-        virtualenv +
-        ('--relocatable', '--python={0}/bin/python'.format(venv_path))
-    )
 
+def file_sha256(path):
+    from hashlib import sha256
+    digest = sha256()
+    with open(path, 'rb') as hashed:
+        for block in iter(lambda: hashed.read(UNPACK_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
 
-def do_install(reqs):
-    from os import environ
 
-    previously_installed = pip_get_installed()
-    required = pip_parse_requirements(reqs)
+def sidecar_path(wheel_path):
+    from os.path import basename, dirname, join
+    return join(dirname(wheel_path), '.index', basename(wheel_path) + '.json')
+
 
-    requirements_as_options = tuple(
-        '--requirement={0}'.format(requirement) for requirement in reqs
+def sidecar_is_current(sidecar, wheel_stat):
+    """Whether the wheel is just as it was, when its sidecar was last checked against it."""
+    return (sidecar['size'], sidecar['mtime'], sidecar['inode']) == (
+        wheel_stat.st_size, wheel_stat.st_mtime, wheel_stat.st_ino,
     )
 
-    # We put the cache in the directory that pip already uses.
-    # This has better security characteristics than a machine-wide cache, and is a
-    #   pattern people can use for open-source projects
-    pipdir = environ['HOME'] + '/.pip'
-    # We could combine these caches to one directory, but pip would search everything twice, going slower.
-    pip_download_cache = pipdir + '/cache'
-    pip_wheels = pipdir + '/wheelhouse'
 
-    environ.update(
+def wheel_sidecar(wheel_path, added=False):
+    """venv-update's notes on a wheel in the wheelhouse: its name, version, requirements (with any environment
+    markers), extras, tags and sha256. They're kept alongside it, in .index/<wheel>.json, so that the wheel
+    needn't be opened (or hashed) again.
+
+    The notes are made when the wheel is added to the wheelhouse (or else, the first time it's seen), and
+    trusted for as long as its size, mtime and inode stay the same. If those change, the wheel is hashed again:
+    the same contents are noted as such, but a changed wheel keeps its old notes, so that verify_wheel refuses it.
+    """
+    from os import stat
+    from os.path import basename
+
+    wheel_stat = stat(wheel_path)
+    sidecar = None if added else read_json(sidecar_path(wheel_path))
+    if sidecar is not None and 'sha256' in sidecar:  # (older notes had no digest)
+        if not sidecar_is_current(sidecar, wheel_stat) and file_sha256(wheel_path) == sidecar['sha256']:
+            sidecar.update(size=wheel_stat.st_size, mtime=wheel_stat.st_mtime, inode=wheel_stat.st_ino)
+            write_json(sidecar_path(wheel_path), sidecar)
+        return sidecar
+
+    metadata = read_wheel_metadata(wheel_path)
+    sidecar = {
+        'name': metadata['Name'],
+        'version': metadata['Version'],
+        'requires': [split_marker(requires) for requires in metadata.get_all('Requires-Dist') or ()],
+        'extras': metadata.get_all('Provides-Extra') or [],
+        'tags': wheel_tags(basename(wheel_path)),
+        'sha256': file_sha256(wheel_path),
+        'size': wheel_stat.st_size,
+        'mtime': wheel_stat.st_mtime,
+        'inode': wheel_stat.st_ino,
+    }
+    write_json(sidecar_path(wheel_path), sidecar)
+    return sidecar
+
+
+def verify_wheel(wheel_path):
+    """Refuse a wheel which has changed since it was added to the wheelhouse, by its recorded sha256.
+    Only a wheel whose size, mtime or inode changed is hashed again.
+    """
+    from os import stat
+    sidecar = wheel_sidecar(wheel_path)
+    if not sidecar_is_current(sidecar, stat(wheel_path)):
+        from pip.exceptions import HashMismatch
+        raise HashMismatch(
+            '{0} has changed since it was added to the wheelhouse: its sha256 was {1}. '
+            'Remove it, and venv-update will build it again.'.format(wheel_path, sidecar['sha256'])
+        )
+
+
+def index_wheels(wheel_dir, since):
+    """Make the sidecars of the wheels added to the wheelhouse since then, which pip didn't build through
+    shared_caches (such as a downloaded wheel, or anything built by --warm-cache).
+    """
+    from glob import glob
+    from os import stat
+    from os.path import join
+    for wheel in glob(join(wheel_dir, '*.whl')):
+        wheel_stat = stat(wheel)
+        if wheel_stat.st_mtime < since:
+            continue
+        sidecar = read_json(sidecar_path(wheel))
+        if sidecar is None or 'sha256' not in sidecar or not sidecar_is_current(sidecar, wheel_stat):
+            wheel_sidecar(wheel, added=True)
+
+
+class SidecarMetadata(object):
+    """A pkg_resources metadata provider, with just the METADATA which a wheel's sidecar can reconstruct."""
+
+    def __init__(self, sidecar):
+        lines = [
+            'Metadata-Version: 2.0',
+            'Name: ' + sidecar['name'],
+            'Version: ' + sidecar['version'],
+        ]
+        lines.extend('Provides-Extra: ' + extra for extra in sidecar['extras'])
+        for requirement, marker in sidecar['requires']:
+            if marker:
+                requirement += '; ' + marker
+            lines.append('Requires-Dist: ' + requirement)
+        self.metadata = {'METADATA': '\n'.join(lines) + '\n'}
+
+    def has_metadata(self, name):
+        return name in self.metadata
+
+    def get_metadata(self, name):
+        return self.metadata[name]
+
+    def get_metadata_lines(self, name):
+        return self.get_metadata(name).splitlines()
+
+
+def wheelhouse_lookup(wheel_dir, supported_tags):
+    """Look up requirements among the wheels in wheel_dir, for a DependencyGraph.
+
+    The wheel pip would choose for a requirement is the newest one which satisfies it, and which has one of the
+    supported (python, abi, platform) tags. It's returned as a pkg_resources distribution, made from its sidecar,
+    or None if no wheel satisfies the requirement: pip would have to look further afield.
+    """
+    from os import listdir
+    from os.path import isdir, join
+    from pip._vendor.pkg_resources import DistInfoDistribution, safe_name
+
+    supported_tags = set(tuple(tag) for tag in supported_tags)
+    by_key = {}
+    if isdir(wheel_dir):
+        for filename in listdir(wheel_dir):
+            if filename.endswith('.whl'):
+                key = safe_name(filename.split('-', 1)[0]).lower()
+                by_key.setdefault(key, []).append(filename)
+
+    def lookup(req):
+        candidates = []
+        for filename in by_key.get(req.key, ()):
+            if supported_tags.isdisjoint(tuple(tag) for tag in wheel_tags(filename)):
+                continue
+            wheel_path = join(wheel_dir, filename)
+            sidecar = wheel_sidecar(wheel_path)
+            candidates.append(DistInfoDistribution(
+                location=wheel_path,
+                metadata=SidecarMetadata(sidecar),
+                project_name=sidecar['name'],
+                version=sidecar['version'],
+            ))
+        satisfying = [dist for dist in candidates if dist in req]
+        if not satisfying:
+            return None
+        return max(satisfying, key=lambda dist: dist.parsed_version)
+    return lookup
+
+
+def installed_files(dist):
+    """The absolute paths of the files which this (pkg_resources) distribution installed.
+
+    These are listed in its RECORD (if it was installed from a wheel) or installed-files.txt (by setup.py).
+    """
+    from os.path import join, normpath
+    if dist.has_metadata('RECORD'):
+        base = dist.location
+        # each row is: path,hash,size -- only the path might have a comma
+        names = [line.rsplit(',', 2)[0].strip('"') for line in dist.get_metadata_lines('RECORD')]
+    elif dist.has_metadata('installed-files.txt'):
+        base = dist.egg_info
+        names = dist.get_metadata_lines('installed-files.txt')
+    else:  # an editable, for example
+        return []
+    return [normpath(join(base, name)) for name in names]
+
+
+def trace_requirements(requirements):
+    """given an iterable of pip InstallRequirements,
+    return the set of required packages (as InstalledDist records), given their transitive requirements.
+    """
+    from pip import logger
+
+    graph = installed_dependency_graph(requirements)
+
+    seen_warnings = set()
+    for req, dist, description in graph.conflicts:
+        # TODO: This should really be an error, but throw a warning for now, while we integrate.
+        # TODO: test case, eg: install pylint, install old astroid, update
+        #       astroid should still be installed after
+        if req.key not in seen_warnings:
+            logger.warn("Warning: version conflict: %s <-> %s", dist, description)
+            seen_warnings.add(req.key)
+
+    if graph.missing:
+        # TODO: test case, eg: install pylint, uninstall astroid, update
+        #       -> Unmet dependency: astroid>=1.3.2 (from pylint (from -r faster.txt (line 4)))
+        for dummy_req, description in graph.missing:
+            logger.error('Unmet dependency: %s', description)
+        exit(1)
+
+    return [InstalledDist.from_dist(graph.nodes[key]) for key in graph.order]
+
+
+def reqnames(reqs):
+    return set(req.name for req in reqs)
+
+
+def path_is_within(path, within):
+    from os.path import relpath, join
+    path = join('.', path)  # eliminate empty-string edge case
+    return not relpath(path, within).startswith('..')
+
+
+def virtualenv_command(venv_path):
+    from sys import executable
+    return (executable, '-m', 'virtualenv', venv_path)
+
+
+# With --single-process, stage1 tells stage2 where to find virtualenv: it isn't installed in the virtualenv.
+VIRTUALENV_ENVIRON = 'VENV_UPDATE_VIRTUALENV'
+
+
+def import_virtualenv():
+    """The virtualenv module, either our own, or (in stage2) the one stage1 used."""
+    from os import environ
+    import sys
+    if VIRTUALENV_ENVIRON not in environ:
+        import virtualenv  # pylint:disable=import-error
+        return virtualenv
+
+    sys.path.insert(0, environ[VIRTUALENV_ENVIRON])
+    try:
+        import virtualenv  # pylint:disable=import-error
+    finally:
+        del sys.path[0]
+    return virtualenv
+
+
+def virtualenv_main(args):
+    """Run virtualenv's command line within this process, rather than starting another python."""
+    import sys
+    virtualenv = import_virtualenv()
+    print(colorize(('virtualenv',) + tuple(args)))
+    sys.stdout.flush()
+
+    argv = sys.argv
+    sys.argv = ['virtualenv'] + list(args)
+    try:
+        virtualenv.main()
+    except SystemExit as error:
+        # virtualenv ran itself again, as a subprocess (for some other python), or else it failed
+        if error.code:
+            raise
+    finally:
+        sys.argv = argv
+
+
+def python_is_current(python):
+    """Whether virtualenv would take this --python (None being its default) to mean the current interpreter.
+    This is virtualenv's own test: any other python, even one with the same identity, gets a subprocess.
+    """
+    from distutils.spawn import find_executable  # pylint:disable=no-name-in-module,import-error
+    from os.path import abspath, sep
+    from sys import executable
+    if python is None:
+        return True
+    interpreter = abspath(python) if sep in python else find_executable(python)
+    return interpreter == executable
+
+
+# Run by a python interpreter, to identify itself. A virtualenv's python is identified with its original.
+IDENTIFY_PYTHON = "import json, sys; print(json.dumps([sys.version, getattr(sys, 'real_prefix', sys.prefix)]))"
+
+
+def interpreter_identity(python=None):
+    """Identify a python interpreter (the current one, by default) by its version and prefix.
+    Returns None if there's no such interpreter.
+    """
+    if python is None:
+        import sys
+        return [sys.version, getattr(sys, 'real_prefix', sys.prefix)]
+
+    from json import loads
+    from subprocess import Popen, PIPE
+    try:
+        process = Popen((python, '-c', IDENTIFY_PYTHON), stdout=PIPE)
+    except OSError:  # virtualenv will complain about this in more detail
+        return None
+    out, _ = process.communicate()
+    if process.returncode != 0:
+        return None
+    return loads(out.decode('UTF-8'))
+
+
+def python_option(arg):
+    """The python named by this virtualenv argument (--python=PYTHON, or -pPYTHON), or None."""
+    if arg.startswith('--python='):
+        return arg[len('--python='):]
+    elif arg.startswith('-p') and arg != '-p':
+        return arg[len('-p'):]
+
+
+def venv_python_option(venv_args):
+    """The python these virtualenv arguments ask for, or None for virtualenv's default: the current python."""
+    python = None
+    for arg in venv_args:
+        python = python_option(arg) or python
+    return python
+
+
+def venv_spec(venv_args):
+    """Describe the virtualenv these arguments would create, such that we can tell if an existing one matches."""
+    python = venv_python_option(venv_args)
+    system_site_packages = False
+    args = []
+    for arg in venv_args:
+        if python_option(arg) is not None:
+            pass
+        elif arg == '--system-site-packages':
+            system_site_packages = True
+        elif arg == '--no-site-packages':
+            system_site_packages = False
+        elif arg not in ('-q', '--quiet', '-v', '--verbose'):
+            args.append(arg)
+
+    return {
+        'python': interpreter_identity(python),
+        'system_site_packages': system_site_packages,
+        'args': args,
+    }
+
+
+def venv_observed_spec(venv_path, args):
+    """The spec of a virtualenv made before we kept notes, so far as we can tell by looking at it.
+
+    Its python and --system-site-packages can be seen; its other arguments get the benefit of the doubt.
+    """
+    from glob import glob
+    from os.path import join
+    return {
+        'python': interpreter_identity(join(venv_path, 'bin', 'python')),
+        'system_site_packages': not glob(join(venv_path, 'lib*', '*', 'no-global-site-packages.txt')),
+        'args': list(args),
+    }
+
+
+def venv_state_path(venv_path, name):
+    """venv-update keeps some notes about each virtualenv, within it."""
+    from os.path import join
+    return join(venv_path, '.venv-update', name)
+
+
+def read_json(path):
+    """Returns None if the file is missing or corrupt."""
+    from json import load
+    try:
+        with open(path) as jsonfile:
+            return load(jsonfile)
+    except (IOError, ValueError):
+        return None
+
+
+def write_json(path, data):
+    from json import dumps
+    write_atomically(path, dumps(data, sort_keys=True).encode('UTF-8'))
+
+
+def venv_set_system_site_packages(venv_path, system_site_packages):
+    """Switch an existing virtualenv's access to the global site-packages, in place, the same way virtualenv would.
+    Returns False if the virtualenv's layout isn't one we understand.
+    """
+    from glob import glob
+    from os import unlink
+    from os.path import dirname, exists, join
+
+    lib_dirs = glob(join(venv_path, 'lib*', '*', 'orig-prefix.txt'))
+    if len(lib_dirs) != 1:
+        return False
+
+    no_global_site_packages = join(dirname(lib_dirs[0]), 'no-global-site-packages.txt')
+    if system_site_packages:
+        if exists(no_global_site_packages):
+            unlink(no_global_site_packages)
+    else:
+        open(no_global_site_packages, 'w').close()
+    return True
+
+
+def venv_create(venv_path, venv_args, in_process=False, skeleton=False):
+    """Create the virtualenv, unless an equivalent one already exists.
+
+    If in_process, virtualenv runs within this process, so long as it would use this same python.
+    If skeleton, a new virtualenv is cloned from a cached one, made by the same arguments.
+    """
+    from os.path import exists, join
+    venv_python = join(venv_path, 'bin', 'python')
+    spec_path = venv_state_path(venv_path, 'venv.json')
+    spec = venv_spec(venv_args)
+
+    def virtualenv(path, args):
+        # for any other python, virtualenv would only run itself again, as a subprocess
+        if in_process and python_is_current(venv_python_option(args)):
+            virtualenv_main((path,) + args)
+        else:
+            run(virtualenv_command(path) + args)
+
+    def create():
+        if skeleton and not exists(venv_path):
+            venv_from_skeleton(venv_path, venv_skeleton(spec, lambda path: virtualenv(path, venv_args)))
+        else:
+            virtualenv(venv_path, venv_args)
+
+    if exists(venv_python):
+        recorded = read_json(spec_path) or venv_observed_spec(venv_path, spec['args'])
+        if recorded == spec:
+            # already done!
+            pass
+        elif (
+                recorded['python'] == spec['python'] and
+                recorded['args'] == spec['args'] and
+                venv_set_system_site_packages(venv_path, spec['system_site_packages'])
+        ):
+            # only --system-site-packages changed: no need to start over
+            pass
+        else:
+            run(('rm', '-rf', venv_path))
+            create()
+    else:
+        create()
+
+    if exists(venv_python):
+        write_json(spec_path, spec)
+
+
+def venv_relocatable(venv_path, in_process=False):
+    """Make our venv relocatable, since we do plan to relocate it, sometimes.
+
+    This must be done by the virtualenv's own python: in_process means that's us.
+    """
+    if in_process:
+        print(colorize(('virtualenv', '--relocatable', venv_path)))
+        import_virtualenv().make_environment_relocatable(venv_path)
+    else:
+        run(
+            virtualenv_command(venv_path) +
+            ('--relocatable', '--python={0}/bin/python'.format(venv_path))
+        )
+
+
+def venv_postprocess(venv_path, in_process=False):
+    with phase('relocatable'):
+        venv_relocatable(venv_path, in_process)
+        restat_manifest(venv_path)
+    mark_venv_valid(venv_path)
+
+
+@contextmanager
+def venv(venv_path, venv_args, skeleton=False):
+    """Ensure we have a virtualenv."""
+    with phase('virtualenv'):
+        venv_create(venv_path, venv_args, skeleton=skeleton)
+    yield
+    venv_postprocess(venv_path)
+
+
+def cache_path(*parts):
+    """A path within venv-update's own cache, which lives alongside pip's."""
+    from os import environ
+    from os.path import join
+    return join(environ['HOME'], '.pip', 'venv-update', *parts)
+
+
+def sha256hex(text):
+    from hashlib import sha256
+    return sha256(text.encode('UTF-8')).hexdigest()
+
+
+def mkdirp(directory):
+    """Make sure this directory exists, even if another process is making it too."""
+    from os import makedirs
+    from os.path import isdir
+    if not isdir(directory):
+        try:
+            makedirs(directory)
+        except OSError:  # someone else made it just now
+            if not isdir(directory):
+                raise
+
+
+@contextmanager
+def atomic_file(path):
+    """Open a file for (binary) writing, such that readers only ever see the whole thing.
+
+    It's renamed into place once the block is done, or removed if the block fails.
+    """
+    from os import close, fdopen, rename, unlink
+    from os.path import dirname
+    from tempfile import mkstemp
+
+    directory = dirname(path) or '.'
+    mkdirp(directory)
+    fd, tmpname = mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        try:
+            tmpfile = fdopen(fd, 'wb')
+        except Exception:
+            close(fd)
+            raise
+        with tmpfile:
+            yield tmpfile
+        rename(tmpname, path)
+    except BaseException:
+        unlink(tmpname)
+        raise
+
+
+def write_atomically(path, content):
+    """Write the (bytes) content to a file, such that readers only ever see the whole thing."""
+    with atomic_file(path) as tmpfile:
+        tmpfile.write(content)
+
+
+def artifact_lock_path(artifact):
+    """The lock file which guards the making of an artifact (a download, or a wheel) in the shared caches."""
+    return cache_path('locks', sha256hex(artifact) + '.lock')
+
+
+def wheel_artifact(name, version):
+    return 'wheel:{0}=={1}'.format(name.lower().replace('-', '_'), version)
+
+
+def flock_exclusive(lockfile):
+    """Lock this open file, waiting for any other holder. Returns whether we had to wait."""
+    from errno import EACCES, EAGAIN
+    from fcntl import flock, LOCK_EX, LOCK_NB
+    try:
+        flock(lockfile.fileno(), LOCK_EX | LOCK_NB)
+        return False
+    except IOError as error:
+        if error.errno not in (EACCES, EAGAIN):
+            raise
+    flock(lockfile.fileno(), LOCK_EX)
+    return True
+
+
+@contextmanager
+def file_lock(path, inheritable=False):
+    """Hold an exclusive lock on this file, for the duration of the block.
+    Yields whether we had to wait for another process to release it.
+
+    The lock belongs to the open file, so it's released even if we're killed.
+    If inheritable, it's also held by any program we exec, until that exits.
+    """
+    import os
+    from os.path import dirname
+    mkdirp(dirname(path))
+    with open(path, 'a') as lockfile:
+        if inheritable and hasattr(os, 'set_inheritable'):  # python2's files are always inheritable
+            os.set_inheritable(lockfile.fileno(), True)  # pylint:disable=no-member
+        yield flock_exclusive(lockfile)
+
+
+def wait_for_lock(path):
+    """If another process holds the lock on this file, wait until they're done. Returns whether we waited."""
+    with file_lock(path) as waited:
+        return waited
+
+
+def pip_cache_options():
+    """Point pip at our caches. Returns the wheelhouse directory, and the pip options which use the caches."""
+    from os import environ
+
+    # We put the cache in the directory that pip already uses.
+    # This has better security characteristics than a machine-wide cache, and is a
+    #   pattern people can use for open-source projects
+    pipdir = environ['HOME'] + '/.pip'
+    # We could combine these caches to one directory, but pip would search everything twice, going slower.
+    pip_download_cache = pipdir + '/cache'
+    pip_wheels = pipdir + '/wheelhouse'
+
+    environ.update(
         PIP_DOWNLOAD_CACHE=pip_download_cache,
     )
 
@@ -390,43 +1878,899 @@ def do_install(reqs):
         '--download-cache=' + pip_download_cache,
         '--find-links=file://' + pip_wheels,
     )
+    return pip_wheels, cache_opts
+
+
+def unique(iterable):
+    """The distinct items, in their original order."""
+    seen = set()
+    result = []
+    for item in iterable:
+        if item not in seen:
+            seen.add(item)
+            result.append(item)
+    return result
+
+
+def write_requirements(lines):
+    """Write a requirements file of our own making. It's named by its content, so it can be reused."""
+    content = '\n'.join(lines) + '\n'
+    path = cache_path('requirements', sha256hex(content) + '.txt')
+    write_atomically(path, content.encode('UTF-8'))
+    return path
+
+
+# The requirement urls which vcs_commit can resolve to a commit, and so whose wheels can be cached.
+VCS_SCHEMES = ('git+', 'hg+')
+
+
+def git_ref_commit(refs, rev):
+    """The commit a git revision names, from the output of `git ls-remote`, or None if it's not there.
+
+    Only a ref named exactly counts: `master` is refs/heads/master, never refs/heads/foo/master. As in pip, a branch
+    is preferred to a tag, and an annotated tag is "peeled" to the commit it tags.
+    """
+    commits = {}
+    for line in refs.splitlines():
+        commit, _, ref = line.partition('\t')
+        commits[ref.strip()] = commit.strip()
+    for ref in ('refs/heads/' + rev, 'refs/tags/' + rev + '^{}', 'refs/tags/' + rev, rev + '^{}', rev):
+        if ref in commits:
+            return commits[ref]
+    return None
+
+
+def vcs_url_rev(url):
+    """Split a vcs requirement url into the vcs, the repository url (without any revision) and the revision, if any."""
+    try:
+        from urlparse import urlsplit, urlunsplit
+    except ImportError:  # python3
+        from urllib.parse import urlsplit, urlunsplit  # pylint:disable=no-name-in-module,import-error
+
+    vcs, _, url = url.partition('+')
+    # this matches the url-munging done in pip.vcs:
+    scheme, netloc, path, query, _ = urlsplit(url)
+    rev = None
+    if '@' in path:
+        path, rev = path.rsplit('@', 1)
+    return vcs, urlunsplit((scheme, netloc, path, query, '')), rev
+
+
+def vcs_commit(url):
+    """Resolve a git+ or hg+ requirement url to its exact commit, without cloning it.
+
+    Returns the repository url (without any revision) and the commit, which is None if this can't be done.
+    """
+    from re import match
+    from subprocess import Popen, PIPE
+
+    vcs, url, rev = vcs_url_rev(url)
+    if rev and match('[0-9a-f]{40}$', rev):
+        return url, rev
+    elif vcs == 'git':
+        rev = rev or 'HEAD'
+        cmd = ('git', 'ls-remote', url, rev, rev + '^{}')
+    elif vcs == 'hg':
+        cmd = ('hg', '--debug', 'identify', '--id', '--rev', rev or 'default', url)
+    else:
+        return url, None
+
+    try:
+        process = Popen(cmd, stdout=PIPE)
+    except OSError:  # no such vcs
+        return url, None
+    out = process.communicate()[0].decode('UTF-8')
+    if vcs == 'git':
+        commit = git_ref_commit(out, rev)
+    else:
+        commit = (out.split() or [None])[0]
+    if process.returncode != 0 or not commit or not match('[0-9a-f]{40}$', commit):
+        return url, None
+    return url, commit
+
+
+def vcs_wheels(required):
+    """Find the cached wheel for each git and hg requirement (except editables), according to its exact commit.
+
+    Returns a dict of {requirement line: cached wheel}, and a list of (requirement, cache directory) for those
+    not yet in the cache.
+    """
+    from glob import glob
+    from os.path import join
+
+    cached = {}
+    uncached = []
+    for req in required:
+        if req.editable or not req.url or not req.url.startswith(VCS_SCHEMES):
+            continue
+
+        url, commit = vcs_commit(req.url)
+        if commit is None:
+            continue
+        vcs = req.url.partition('+')[0]
+        cachedir = cache_path('vcs-wheels', sha256hex(vcs + '+' + url), commit)
+
+        wheels = glob(join(cachedir, '*.whl'))
+        if wheels:
+            cached[requirement_line(req)] = wheels[0]
+        else:
+            uncached.append((req, cachedir))
+
+    return cached, uncached
+
+
+def save_vcs_wheels(uncached):
+    """Copy the wheels just built for these vcs requirements (see BUILT_WHEELS) into their places in the vcs-wheel
+    cache."""
+    from os.path import basename, join
+
+    for req, cachedir in uncached:
+        for wheel in BUILT_WHEELS.get(req.url, ()):
+            with open(wheel, 'rb') as wheel_file:
+                write_atomically(join(cachedir, basename(wheel)), wheel_file.read())
+
+
+def installed_egg_links():
+    """The projects installed via `setup.py develop`: {project directory: location of its egg-info}"""
+    from distutils.sysconfig import get_python_lib  # pylint:disable=no-name-in-module,import-error
+    from glob import glob
+    from os.path import join, normpath
+
+    result = {}
+    for egg_link in glob(join(get_python_lib(), '*.egg-link')):
+        with open(egg_link) as egg_link_file:
+            # the egg-info's location, then the relative path from there to the project
+            lines = [line.strip() for line in egg_link_file] + ['.']
+        location = normpath(lines[0])
+        result[normpath(join(location, lines[1]))] = location
+    return result
+
+
+def editable_fingerprint(location, source_dir):
+    """Summarize what `setup.py develop` depends on: the setup files, and the egg-info it generates."""
+    from glob import glob
+    from hashlib import sha256
+    from os import listdir, stat
+    from os.path import exists, join
+
+    fingerprint = sha256()
+    for filename in ('setup.py', 'setup.cfg'):
+        filename = join(source_dir, filename)
+        if exists(filename):
+            with open(filename, 'rb') as setup_file:
+                fingerprint.update(setup_file.read())
+        fingerprint.update(b'\0')
+
+    for egg_info in sorted(glob(join(location, '*.egg-info'))):
+        for filename in sorted(listdir(egg_info)):
+            info = stat(join(egg_info, filename))
+            fingerprint.update('{0} {1} {2!r}\0'.format(filename, info.st_size, info.st_mtime).encode('UTF-8'))
+    return fingerprint.hexdigest()
+
+
+def local_editables(required):
+    """The editable requirements which are directories on this machine: (requirement, project directory)"""
+    from os.path import normpath
+    for req in required:
+        if req.editable and req.source_dir and req.url.startswith('file:'):
+            yield req, normpath(req.source_dir)
+
+
+def unchanged_editables(required):
+    """The local editable requirements whose fingerprint hasn't changed since we last did `setup.py develop`.
+
+    As a side effect, these requirements are given their project name, so that their dependencies can be traced.
+    """
+    from sys import prefix
+    from pip._vendor.pkg_resources import Requirement, find_distributions
+
+    recorded = read_json(venv_state_path(prefix, 'editables.json')) or {}
+    egg_links = installed_egg_links()
+    result = []
+    for req, source_dir in local_editables(required):
+        location = egg_links.get(source_dir)
+        if location is None or recorded.get(source_dir) != editable_fingerprint(location, source_dir):
+            continue
+
+        dists = list(find_distributions(location, only=True))
+        if len(dists) != 1:
+            continue
+
+        if req.req is None:
+            req.req = Requirement.parse(dists[0].project_name)
+        result.append(req)
+    return result
+
+
+def record_editables(required):
+    """Record the fingerprints of the local editables, after a successful `setup.py develop`."""
+    from sys import prefix
+
+    egg_links = installed_egg_links()
+    recorded = {}
+    for dummy_req, source_dir in local_editables(required):
+        location = egg_links.get(source_dir)
+        if location is not None:
+            recorded[source_dir] = editable_fingerprint(location, source_dir)
+    write_json(venv_state_path(prefix, 'editables.json'), recorded)
+
+
+def file_stats(paths, root):
+    """{path: [size, mtime]}, for each of these files which exists. Relative paths are relative to `root`.
+
+    Like rsync, we trust the mtime to the second: copying a file (see clone_venv) may lose the rest.
+    Directories are left out: clone_venv makes them anew, and their files are noted in any case.
+    """
+    from os import stat
+    from os.path import join
+    from stat import S_ISDIR
+    result = {}
+    for path in paths:
+        try:
+            path_stat = stat(join(root, path))
+        except OSError:  # it's gone
+            continue
+        if not S_ISDIR(path_stat.st_mode):
+            result[path] = [path_stat.st_size, int(path_stat.st_mtime)]
+    return result
+
+
+# virtualenv installs these itself, and they're never in the wheelhouse: drift can't repair them, so it ignores them.
+VIRTUALENV_DISTS = ('pip', 'setuptools')
+
+
+def record_manifest(fingerprint):
+    """After a successful update, note the size and mtime of each file each distribution installed.
+
+    Bytecode is left out, since python rewrites it as it sees fit.
+    Since --relocatable then rewrites the scripts, stage1 notes their new stats afterward (see restat_manifest).
+    Files within the virtualenv are noted relative to it, so that the notes still hold once it's moved
+    (or swapped into place, by --transactional).
+    `fingerprint` identifies the requirements which the virtualenv now fulfills.
+    """
+    from os.path import relpath
+    from sys import prefix
+    working_set = fresh_working_set()
+    dists = {}
+    for key, info in installed_index().items():
+        dist = working_set.by_key.get(key)
+        if dist is not None and key not in VIRTUALENV_DISTS:
+            dists[key] = {
+                'version': info['version'],
+                'files': file_stats((
+                    relpath(path, prefix) if path_is_within(path, prefix) else path
+                    for path in installed_files(dist) if not path.endswith(('.pyc', '.pyo'))
+                ), prefix),
+            }
+    write_json(venv_state_path(prefix, 'manifest.json'), {'fingerprint': fingerprint, 'dists': dists})
+
+
+def restat_manifest(venv_path):
+    """Once the virtualenv is made relocatable, note the new size and mtime of each file in its manifest."""
+    manifest_path = venv_state_path(venv_path, 'manifest.json')
+    manifest = read_json(manifest_path)
+    if manifest is None:
+        return
+    for dist in manifest['dists'].values():
+        dist['files'] = file_stats(dist['files'], venv_path)
+    write_json(manifest_path, manifest)
+
+
+def manifest_drift(manifest, installed, root):
+    """How the virtualenv (at `root`) has drifted from its manifest (see record_manifest), only stat-ing the
+    recorded files.
+
+    Returns the projects which need to be reinstalled (their version changed, they were removed, or one of
+    their files was changed or removed), and those which were installed since. pip and setuptools are left out.
+    """
+    changed = []
+    for key, recorded in sorted(manifest.items()):
+        if key in VIRTUALENV_DISTS:
+            continue
+        current = installed.get(key)
+        if (
+                current is None or
+                current['version'] != recorded['version'] or
+                file_stats(recorded['files'], root) != recorded['files']
+        ):
+            changed.append(key)
+    extra = sorted(set(installed) - set(manifest) - set(VIRTUALENV_DISTS))
+    return changed, extra
+
+
+def repair_drift(required, unchanged, fingerprint, install_opts):
+    """If the requirements are the same as at our last successful update, the virtualenv can only have changed by
+    hand since then. In that case, repair just the distributions which drifted, and return True.
+
+    Otherwise (or if the repair fails) return False: the full update needs to go ahead.
+    An unpinned requirement, or a changed editable (ie. not in `unchanged`), always needs the full update.
+    """
+    from sys import prefix
+    manifest = read_json(venv_state_path(prefix, 'manifest.json'))
+    if manifest is None or manifest['fingerprint'] != fingerprint:
+        return False
+    editables = [req for req in required if req.editable]
+    if len(editables) != len(unchanged):
+        return False
+    for req in required:
+        if not req.editable and not req_is_absolute(req.req):
+            return False
+
+    changed, extra = manifest_drift(manifest['dists'], installed_index(), prefix)
+    if not changed and not extra:
+        print('Nothing has changed since the last update.')
+        return True
+
+    try:
+        if changed:
+            pip_install(install_opts + ('--no-deps', '--force-reinstall') + tuple(
+                '{0}=={1}'.format(key, manifest['dists'][key]['version']) for key in changed
+            ))
+        if extra:
+            pip(('uninstall', '--yes') + tuple(extra))
+    except SystemExit:  # pip failed: perhaps the wheel has gone from the wheelhouse
+        return False
+
+    installed_index(updated=set(changed) | set(extra))
+    record_manifest(fingerprint)
+    return True
+
+
+SDIST_EXTENSIONS = ('.tar.gz', '.tgz', '.tar.bz2', '.tbz', '.tar', '.zip')
+
+
+def sdist_name_version(filename):
+    """The name-version of an sdist, from its filename, or None if it's not an sdist."""
+    for ext in SDIST_EXTENSIONS:
+        if filename.endswith(ext):
+            return filename[:-len(ext)]
+
+
+def wheel_is_universal(filename):
+    """Whether this wheel suits every python, and so can stand in for its sdist, whichever python builds from it."""
+    pure_pythons = set(python for python, abi, platform in wheel_tags(filename) if (abi, platform) == ('none', 'any'))
+    return pure_pythons >= set(('py2', 'py3'))
+
+
+def remove_download(download_cache, cached, url):
+    """Remove one download from the cache. Returns its size, in bytes."""
+    from os import unlink
+    from os.path import exists, getsize, join
+    size = 0
+    # don't pull it out from under anyone who's using it right now
+    with file_lock(artifact_lock_path('download:' + url)):
+        path = join(download_cache, cached)
+        if exists(path):
+            size = getsize(path)
+            unlink(path)
+        if exists(path + '.content-type'):
+            unlink(path + '.content-type')
+    return size
+
+
+def collapse_download_cache(download_cache, wheel_dir):
+    """Remove each download that's already in the wheelhouse, or was built into a (universal) wheel there.
+    An sdist whose wheel suits only some pythons is kept, for the others to build from.
+
+    Returns the number of downloads removed, and their size, in bytes.
+    """
+    from os import listdir
+    from os.path import isdir
+    try:
+        from urllib.parse import unquote  # pylint:disable=no-name-in-module,import-error
+    except ImportError:  # python2
+        from urllib import unquote
+
+    if not isdir(download_cache) or not isdir(wheel_dir):
+        return 0, 0
+
+    def normalize(name_version):
+        return name_version.lower().replace('_', '-')
+
+    wheels = set(filename for filename in listdir(wheel_dir) if filename.endswith('.whl'))
+    built = set(normalize('-'.join(wheel.split('-')[:2])) for wheel in wheels if wheel_is_universal(wheel))
+
+    removed = size = 0
+    for cached in sorted(listdir(download_cache)):
+        if cached.startswith('.') or cached.endswith('.content-type'):
+            continue
+        # this matches the name-munging done in pip.download:
+        url = unquote(cached)
+        filename = url.split('?', 1)[0].rsplit('/', 1)[-1]
+        if filename not in wheels:  # a downloaded wheel, or else an sdist
+            name_version = sdist_name_version(filename)
+            if name_version is None or normalize(name_version) not in built:
+                continue
+        size += remove_download(download_cache, cached, url)
+        removed += 1
+    return removed, size
+
+
+def collapse_cache(options):
+    """For --collapse-cache: shrink the download cache, after building some wheels.
+
+    Only the storage is collapsed. Lookups go on as before: a pinned requirement is found in the wheelhouse (see
+    faster_pip_packagefinder), but anything else still goes to the index, and to the downloads that remain.
+    """
+    from os import environ
+    if not options.get('collapse-cache'):
+        return
+    pip_wheels, dummy_cache_opts = pip_cache_options()
+    removed, size = collapse_download_cache(environ['PIP_DOWNLOAD_CACHE'], pip_wheels)
+    if removed:
+        print('Removed {0} downloads ({1} bytes) from the download cache, since they have wheels.'.format(
+            removed, size,
+        ))
+
+
+def build_wheels(reqs, pip_wheels, cache_opts):
+    """Make sure everything required by any of these requirements files is downloaded, cached, and has a wheel.
+    Requirements shared between the files are only built once.
+    """
+    from time import time
+
+    pip_opts = pip_options(reqs)
+    required = cached_parse_requirements(reqs)
+    cached_vcs_wheels, uncached_vcs_wheels = vcs_wheels(required)
+
+    since = int(time())
+    for number, lines in enumerate(requirement_rounds(required)):
+        lines = [cached_vcs_wheels.get(line, line) for line in lines]
+        pip(
+            ('wheel', '--wheel-dir=' + pip_wheels) +
+            (BOOTSTRAP_VERSIONS if number == 0 else ()) +
+            cache_opts +
+            ('--requirement=' + write_requirements(pip_opts + lines),)
+        )
+    save_vcs_wheels(uncached_vcs_wheels)
+    index_wheels(pip_wheels, since)
+
+
+def do_build(reqs, options):
+    """Only populate the caches, for a --batch of virtualenvs."""
+    pip_wheels, cache_opts = pip_cache_options()
+
+    # wheel is needed to build wheels
+    with phase('bootstrap'):
+        pip_install(('--upgrade', '--use-wheel') + cache_opts + BOOTSTRAP_VERSIONS)
+    with phase('wheel'):
+        build_wheels(reqs, pip_wheels, cache_opts)
+        collapse_cache(options)
+    return 0
+
+
+def unbuilt_requirements(wheel_dir, required, cached_vcs_wheels):
+    """The requirements --warm-cache needs to build: those with no wheel in wheel_dir yet, and the requirements of the
+    others, all the way down, which no wheel satisfies. An editable always needs building. The requirements of a
+    cached vcs wheel aren't checked.
+    """
+    from pip.pep425tags import supported_tags
+    from pip.req import InstallRequirement
+
+    unbuilt = []
+    built = []
+    for req in required:
+        if requirement_line(req) in cached_vcs_wheels:
+            pass
+        elif req.editable or not wheel_is_built(wheel_dir, req.req):
+            unbuilt.append(req)
+        else:
+            built.append(req)
+
+    wheelhouse = wheelhouse_lookup(wheel_dir, supported_tags)
+    graph = DependencyGraph(wheelhouse).add(built)
+    # another requirement's wheel may be in the way of a conflicting requirement; it only needs one of its own
+    unsatisfied = [req for req, dummy_description in graph.missing] + [
+        req for req, dummy_dist, dummy_description in graph.conflicts if wheelhouse(req) is None
+    ]
+    return unbuilt + [InstallRequirement.from_line(str(req)) for req in unsatisfied]
+
+
+def warm_cache(reqs, options):
+    """Build just the missing wheels for all of these requirements files, in parallel, then exit.
+
+    This runs in the current interpreter (which needs pip and wheel), without any virtualenv.
+    """
+    from multiprocessing import cpu_count
+    from time import time
+    from pip._vendor.pkg_resources import Requirement
+
+    pip_wheels, dummy_cache_opts = pip_cache_options()
+    required = cached_parse_requirements(reqs)
+    cached_vcs_wheels, dummy_uncached_vcs_wheels = vcs_wheels(required)
+
+    missing = unbuilt_requirements(pip_wheels, required, cached_vcs_wheels)
+    missing_bootstrap = [
+        line for line in BOOTSTRAP_VERSIONS
+        if not wheel_is_built(pip_wheels, Requirement.parse(line))
+    ]
+
+    since = int(time())
+    exit_code = run_wheel_workers(
+        pip_options(reqs), requirement_rounds(missing), missing_bootstrap, int(options.get('jobs') or cpu_count()),
+    )
+    index_wheels(pip_wheels, since)
+    collapse_cache(options)
+    return exit_code
+
+
+def run_wheel_workers(pip_opts, rounds, bootstrap, jobs):
+    """Build each round of requirement lines with (at most) `jobs` --wheel-worker processes at a time, and the
+    bootstrap lines alongside the first round. Returns the first failing worker's exit code, if any.
+    """
+    from sys import executable
+
+    def pip_wheel(lines):
+        return (executable, dotpy(__file__), '--wheel-worker=' + write_requirements(pip_opts + lines))
+
+    exit_code = 0
+    for number, lines in enumerate(rounds or [[]]):
+        # each of the processes gets an even share of the round
+        commands = [pip_wheel(lines[job::jobs]) for job in range(min(jobs, len(lines)))]
+        if number == 0 and bootstrap:
+            commands.append(pip_wheel(bootstrap))
+
+        for returncode in run_parallel(commands, jobs):
+            exit_code = exit_code or returncode
+    return exit_code
+
+
+def wheel_worker(requirements_file):
+    """Build the wheels for --warm-cache, with our patched pip, so that builds running in parallel (even for
+    other pythons) take turns at each wheel, through shared_caches.
+    """
+    pip_wheels, cache_opts = pip_cache_options()
+    dummy_cached_vcs_wheels, uncached_vcs_wheels = vcs_wheels(cached_parse_requirements((requirements_file,)))
+    try:
+        pip(('wheel', '--wheel-dir=' + pip_wheels) + cache_opts + ('--requirement=' + requirements_file,))
+        # only this process knows which wheel each build made
+        save_vcs_wheels(uncached_vcs_wheels)
+    finally:
+        report_cache_counters()
+    return 0
+
+
+COMPILE_MODES = ('parallel', 'new', 'lazy')
+
+
+def bytecode_path(source):
+    """Where python would write the bytecode of this source file."""
+    try:
+        from importlib.util import cache_from_source  # pylint:disable=no-name-in-module,import-error
+    except ImportError:
+        try:
+            from imp import cache_from_source  # pylint:disable=no-name-in-module,import-error
+        except ImportError:
+            # python2
+            return source + ('c' if __debug__ else 'o')
+    return cache_from_source(source)
+
+
+def compile_source(source):
+    """Byte-compile one python file, unless its bytecode is up to date. Returns any error, as a string."""
+    from os.path import getmtime
+    from py_compile import compile, PyCompileError  # pylint:disable=redefined-builtin
+    try:
+        if getmtime(bytecode_path(source)) >= getmtime(source):
+            return None
+    except OSError:
+        pass  # not compiled yet
+
+    try:
+        compile(source, doraise=True)
+    except PyCompileError as error:
+        return error.msg
+    except (IOError, OSError) as error:
+        return '{0}: {1}'.format(source, error)
+
+
+def compile_parallel(sources):
+    """Byte-compile these python files with a pool of processes, one per cpu."""
+    from multiprocessing import Pool, cpu_count
+    if not sources:
+        return
+
+    pool = Pool(cpu_count())
+    try:
+        errors = pool.map(compile_source, sources, chunksize=32)
+    finally:
+        pool.close()
+        pool.join()
+
+    for error in errors:
+        if error:
+            print(error)
+
+
+def site_packages_sources():
+    """Every python file in this virtualenv's site-packages."""
+    from os import walk
+    from os.path import join
+    from distutils.sysconfig import get_python_lib  # pylint:disable=no-name-in-module,import-error
+
+    sources = []
+    for site_packages in unique((get_python_lib(), get_python_lib(plat_specific=True))):
+        for dirpath, dummy_dirnames, filenames in walk(site_packages):
+            sources.extend(join(dirpath, filename) for filename in filenames if filename.endswith('.py'))
+    return sources
+
+
+def installed_sources(names):
+    """The python files installed by these projects."""
+    from pip._vendor.pkg_resources import safe_name
+    working_set = fresh_working_set()
+    sources = []
+    for name in sorted(names):
+        dist = working_set.by_key.get(safe_name(name).lower())
+        if dist is not None:
+            sources.extend(path for path in installed_files(dist) if path.endswith('.py'))
+    return sources
+
+
+def builder_venv(python):
+    """A virtualenv for building another interpreter's wheels, kept in our cache. Returns its python.
+
+    It has the same pip as any virtualenv we'd make, plus wheel.
+    """
+    from json import dumps
+    from os.path import exists, join
+
+    identity = interpreter_identity(python)
+    if identity is None:
+        exit('python interpreter not found: %s' % python)
+    venv_path = cache_path('builders', sha256hex(dumps(identity)))
+    venv_python = join(venv_path, 'bin', 'python')
+
+    with file_lock(venv_path + '.lock'):
+        if not exists(venv_python):
+            run(virtualenv_command(venv_path) + ('--quiet', '--python=' + python))
+            dummy_pip_wheels, cache_opts = pip_cache_options()
+            run((venv_python, '-m', 'pip.__main__', 'install', '--quiet') + cache_opts + BOOTSTRAP_VERSIONS)
+    return venv_python
+
+
+def warm_cache_interpreters(reqs, interpreters, options):
+    """--warm-cache for each of these interpreters at once, each in its own builder virtualenv.
+
+    Wheels are tagged by the interpreters they suit, so these can all share the wheelhouse.
+    """
+    from multiprocessing import cpu_count
+    jobs = int(options.get('jobs') or cpu_count())
+
+    commands = [
+        (builder_venv(python), dotpy(__file__), '--warm-cache', '--jobs={0}'.format(max(1, jobs // len(interpreters))))
+        + stage2_options(options) + tuple(reqs)
+        for python in interpreters
+    ]
+    exit_code = 0
+    for returncode in run_parallel(commands, len(commands)):
+        exit_code = exit_code or returncode
+    return exit_code
+
+
+def do_install(reqs, options):
+    from time import time
+    pip_wheels, cache_opts = pip_cache_options()
+
+    previously_installed = pip_get_installed()
+    required = cached_parse_requirements(reqs)
+    fingerprint = requirements_fingerprint(reqs)
+    unchanged = unchanged_editables(required)
 
     # --use-wheel is somewhat redundant here, but it means we get an error if we have a bad version of pip/setuptools.
     install_opts = ('--upgrade', '--use-wheel',) + cache_opts
+    if options.get('compile'):
+        install_opts += ('--no-compile',)  # we'll do it ourselves, if at all
+
+    # 0) If nothing's changed since our last update, except by hand, just undo that.
+    with phase('drift'):
+        if repair_drift(required, unchanged, fingerprint, install_opts + ('--no-index',)):
+            collapse_cache(options)  # the wheels may have come from an update without it
+            return 0
+
+    requirements_as_options, uncached_vcs_wheels = install_requirements_options(reqs, required, unchanged)
     recently_installed = []
 
     # 1) Bootstrap the install system; setuptools and pip are already installed, just need wheel
-    recently_installed += pip_install(install_opts + BOOTSTRAP_VERSIONS)
+    with phase('bootstrap'):
+        recently_installed += pip_install(install_opts + BOOTSTRAP_VERSIONS)
 
     # 2) Caching: Make sure everything we want is downloaded, cached, and has a wheel.
-    pip(
-        ('wheel', '--wheel-dir=' + pip_wheels) +
-        BOOTSTRAP_VERSIONS +
-        cache_opts +
-        requirements_as_options
-    )
+    #   A --batch has already done this, for all of its virtualenvs at once.
+    if not options.get('no-build'):
+        with phase('wheel'):
+            since = int(time())
+            pip(
+                ('wheel', '--wheel-dir=' + pip_wheels) +
+                BOOTSTRAP_VERSIONS +
+                cache_opts +
+                requirements_as_options
+            )
+            save_vcs_wheels(uncached_vcs_wheels)
+            index_wheels(pip_wheels, since)
+            collapse_cache(options)
 
     # 3) Install: Use our well-populated cache, to do the installations.
     install_opts += ('--no-index',)  # only use the cache
-    recently_installed += pip_install(install_opts + requirements_as_options)
-
-    required_with_deps = trace_requirements(required)
-
-    # TODO-TEST require A==1 then A==2
-    extraneous = (
-        reqnames(previously_installed) -
-        reqnames(required_with_deps) -
-        reqnames(recently_installed) -
-        set(['pip', 'setuptools', 'wheel'])  # the stage1 bootstrap packages
-    )
+    with phase('install'):
+        recently_installed += pip_install(install_opts + requirements_as_options)
+
+    with phase('trace'):
+        # TODO-TEST require A==1 then A==2
+        extraneous = (
+            reqnames(previously_installed) -
+            reqnames(trace_requirements(required)) -
+            reqnames(recently_installed) -
+            set(['pip', 'setuptools', 'wheel'])  # the stage1 bootstrap packages
+        )
 
     # 2) Uninstall any extraneous packages.
     if extraneous:
-        pip(('uninstall', '--yes') + tuple(sorted(extraneous)))
+        with phase('uninstall'):
+            pip(('uninstall', '--yes') + tuple(sorted(extraneous)))
+
+    if options.get('compile') in ('parallel', 'new'):
+        with phase('compile'):
+            compile_installed(options['compile'], recently_installed)
+
+    installed_index(updated=reqnames(recently_installed) | extraneous)
+    record_editables(required)
+    record_manifest(fingerprint)
 
     return 0  # posix:success!
 
 
+def install_requirements_options(reqs, required, unchanged):
+    """The --requirement options for installing these requirements, and the vcs requirements whose wheels we'll
+    need to save, once they're built (see vcs_wheels).
+    """
+    cached_vcs_wheels, uncached_vcs_wheels = vcs_wheels(required)
+    # substitute the already-built wheels for their vcs urls, so that pip doesn't need to clone them
+    substitutions = dict(cached_vcs_wheels)
+    # and leave out editables which `setup.py develop` would do nothing new for
+    for req in unchanged:
+        substitutions[requirement_line(req)] = None
+
+    if substitutions:
+        lines = [
+            substitutions.get(line, line)
+            for line in unique(requirement_line(req) for req in required)
+        ]
+        requirements_as_options = ('--requirement=' + write_requirements(
+            pip_options(reqs) + [line for line in lines if line is not None]
+        ),)
+    else:
+        requirements_as_options = tuple(
+            '--requirement={0}'.format(requirement) for requirement in reqs
+        )
+    return requirements_as_options, uncached_vcs_wheels
+
+
+def compile_installed(mode, recently_installed):
+    """Byte-compile, for --compile=parallel (all of site-packages) or --compile=new (just what we installed)."""
+    if mode == 'parallel':
+        sources = site_packages_sources()
+    else:
+        sources = installed_sources(reqnames(recently_installed))
+    compile_parallel(sources)
+
+
+def plan_targets(reqs):
+    """The version each project would have, after an update to these requirements.
+
+    The target versions, and their requirements, come from the wheelhouse's sidecars; an installed editable
+    stays as it is (its target is None). Nothing is installed, or even unpacked, to find this out.
+    Returns the targets, {key: version}, and a description of each requirement the wheelhouse can't resolve,
+    or which conflicts with the version another requirement resolved to.
+    """
+    from pip.req import InstallRequirement
+
+    pip_wheels, dummy_cache_opts = pip_cache_options()
+    required = list(cached_parse_requirements(reqs)) + [
+        InstallRequirement.from_line(line) for line in BOOTSTRAP_VERSIONS
+    ]
+    editables = set(req.req.key for req in required if req.editable and req.req is not None)
+
+    graph = DependencyGraph(plan_lookup(pip_wheels, editables)).add(required)
+    target = dict((key, dist.version) for key, dist in graph.nodes.items())
+    for key in editables:
+        target[key] = None
+
+    unresolved, pinned = graph_unresolved(graph, editables)
+    target.update(pinned)
+    return target, unresolved
+
+
+def plan_lookup(wheel_dir, editables):
+    """Look up requirements for plan_targets: editables as they're installed, and everything else in the wheelhouse."""
+    from pip.pep425tags import supported_tags
+
+    wheelhouse = wheelhouse_lookup(wheel_dir, supported_tags)
+    if not editables:
+        return wheelhouse
+    by_key = fresh_working_set().by_key
+
+    def lookup(req):
+        if req.key in editables:
+            return by_key.get(req.key)
+        else:
+            return wheelhouse(req)
+    return lookup
+
+
+def graph_unresolved(graph, ignored=()):
+    """Describe each requirement the DependencyGraph couldn't resolve: none was found, or what was found for another
+    requirement doesn't satisfy it. Projects in `ignored` are left out.
+
+    Also returns the version each missing, pinned requirement names (it tells us that much, at least): {key: version}
+    """
+    unresolved = []
+    pinned = {}
+    for req, description in graph.missing:
+        if req.key not in ignored:
+            unresolved.append(description)
+            pinned.update((req.key, version) for qualifier, version in req.specs if qualifier == '==')
+    for req, dummy_dist, description in graph.conflicts:
+        if req.key not in ignored:
+            unresolved.append(description)
+    return unresolved, pinned
+
+
+def plan_diff(target, installed):
+    """Compare the target versions (see plan_targets) to the `installed` distributions (see installed_index).
+    Returns {install, upgrade, downgrade, remove}, each a list, sorted by project.
+    """
+    from pip._vendor.pkg_resources import parse_version
+
+    result = {'install': [], 'upgrade': [], 'downgrade': [], 'remove': []}
+    for key, version in sorted(target.items()):
+        current = installed.get(key)
+        if current is None:
+            result['install'].append({'name': key, 'version': version})
+        elif version is None or current['version'] == version:
+            continue
+        elif parse_version(version) > parse_version(current['version']):
+            result['upgrade'].append({'name': key, 'from': current['version'], 'to': version})
+        else:
+            result['downgrade'].append({'name': key, 'from': current['version'], 'to': version})
+
+    for key, current in sorted(installed.items()):
+        if key not in target and key not in ('pip', 'setuptools', 'wheel'):  # the stage1 bootstrap packages
+            result['remove'].append({'name': key, 'version': current['version']})
+    return result
+
+
+def plan(reqs, installed):
+    """What an update to these requirements would do, given the `installed` distributions (see installed_index).
+    Returns {install, upgrade, downgrade, remove, unresolved}, each a list, sorted by project.
+    """
+    target, unresolved = plan_targets(reqs)
+    result = plan_diff(target, installed)
+    result['unresolved'] = unresolved
+    return result
+
+
+def plan_update(stage, venv_path, reqs, options):
+    """Show what an update would do, as json, without doing any of it (see plan)."""
+    from json import dumps
+    from os.path import abspath, exists, join
+    from subprocess import call
+
+    venv_python = abspath(join(venv_path, 'bin', 'python'))
+    if stage == 1 and exists(venv_python):
+        # the virtualenv's own python knows what's installed there, and what it supports
+        return call(stage2_command(venv_python, venv_path, reqs, formatopts({'plan': options['plan']})))
+
+    # in stage1, there's no virtualenv yet: everything will be installed
+    installed = installed_index(save=False) if stage == 2 else {}
+    result = dumps(plan(reqs, installed), indent=2, sort_keys=True)
+    if options['plan'] is True:
+        print(result)
+    else:
+        write_atomically(options['plan'], (result + '\n').encode('UTF-8'))
+    return 0
+
+
 def wait_for_all_subprocesses():
     from os import wait
     try:
@@ -439,6 +2783,12 @@ def wait_for_all_subprocesses():
             raise
 
 
+def mark_venv_valid(venv_path):
+    """Bring the virtualenv's mtime up to date, so that make knows it's valid, even if nothing needed changing."""
+    from os import utime
+    utime(venv_path, None)
+
+
 def mark_venv_invalid(venv_path, reqs):
     from os.path import isdir
     if isdir(venv_path):
@@ -458,7 +2808,11 @@ def dotpy(filename):
         return filename
 
 
-def stage1(venv_python, reqs, venv_path):
+def stage2_command(venv_python, venv_path, reqs, options=()):
+    return (venv_python, dotpy(__file__), '--stage2') + tuple(options) + (venv_path,) + tuple(reqs)
+
+
+def stage1(venv_python, reqs, venv_path, options):
     """we have an arbitrary python interpreter active, (possibly) outside the virtualenv we want.
 
     make a fresh venv at the right spot, and use it to perform stage 2
@@ -467,37 +2821,364 @@ def stage1(venv_python, reqs, venv_path):
     if not exists(venv_python):
         exit('virtualenv executable not found: %s' % venv_python)
 
-    run((venv_python, dotpy(__file__), '--stage2', venv_path) + reqs)
+    run(stage2_command(venv_python, venv_path, reqs, stage2_options(options)))
 
 
-def stage2(venv_python, reqs):
+def stage1_exec(venv_python, reqs, venv_path, options):
+    """For --single-process: become the virtualenv's python, to perform stage 2 (and the rest of stage 1)."""
+    from os import environ, execv
+    from os.path import dirname, exists
+    import sys
+    if not exists(venv_python):
+        exit('virtualenv executable not found: %s' % venv_python)
+
+    environ[VIRTUALENV_ENVIRON] = dirname(import_virtualenv().__file__)
+    stage2_opts = dict(
+        (name, value) for name, value in options.items()
+        if name in STAGE2_OPTIONS + ('single-process', 'last-update')
+    )
+    cmd = stage2_command(venv_python, venv_path, reqs, formatopts(stage2_opts))
+    print(colorize(cmd))
+    sys.stdout.flush()
+    sys.stderr.flush()
+    execv(venv_python, cmd)
+
+
+def stage2(venv_python, reqs, options):
     """we're activated into the venv we want, and there should be nothing but pip and setuptools installed.
     """
     import sys
     assert sys.executable == venv_python, "Executable not in venv: %s != %s" % (sys.executable, venv_python)
-    return do_install(reqs)
+    try:
+        if options.get('build-only'):
+            return do_build(reqs, options)
+        else:
+            return do_install(reqs, options)
+    finally:
+        report_cache_counters()
+
+
+# pip and virtualenv rewrite these files in place, so a clone of the virtualenv needs its own copy.
+REWRITTEN_IN_PLACE = ('.pth', '.egg-link')
+
+
+def clone_venv(src, dst):
+    """Copy a virtualenv, cheaply: files are hardlinked, except those which may be rewritten in place.
+    Symlinks which point within the virtualenv are made relative, so that they work in either place.
+    """
+    from os import makedirs, walk
+    from os.path import abspath, islink, join, relpath
+    from shutil import copystat
+
+    src = abspath(src)
+    for dirpath, dirnames, filenames in walk(src):
+        dstpath = join(dst, relpath(dirpath, src))
+        makedirs(dstpath)
+        copystat(dirpath, dstpath)
+        in_bindir = dirpath == join(src, 'bin')
+
+        for name in dirnames + filenames:
+            if islink(join(dirpath, name)):
+                clone_symlink(join(dirpath, name), join(dstpath, name), src)
+            elif name not in dirnames:
+                clone_file(join(dirpath, name), join(dstpath, name), in_bindir or name.endswith(REWRITTEN_IN_PLACE))
+        # walk doesn't descend into symlinked directories; we don't either
+        dirnames[:] = [name for name in dirnames if not islink(join(dirpath, name))]
+
+
+def clone_symlink(src, dst, root):
+    """Copy a symlink. One which points within root is made relative, so that it works in either place."""
+    from os import readlink, symlink
+    from os.path import dirname, isabs, relpath
+
+    target = readlink(src)
+    if isabs(target) and path_is_within(target, root):
+        target = relpath(target, dirname(src))
+    symlink(target, dst)
+
+
+def clone_file(src, dst, rewritten):
+    """Hardlink a file, or copy it, if it may be rewritten in place."""
+    from os import link
+    from shutil import copy2
+    if rewritten:
+        copy2(src, dst)
+    else:
+        try:
+            link(src, dst)
+        except OSError:  # eg: a different filesystem
+            copy2(src, dst)
+
+
+def venv_skeleton(spec, create):
+    """A bare virtualenv (just pip and setuptools) of this spec, kept in our cache. Returns its path.
+
+    create(path) makes it, the first time.
+    """
+    from os.path import exists
+    from shutil import rmtree
+    from json import dumps
+
+    skeleton = cache_path('skeletons', sha256hex(dumps(spec, sort_keys=True)))
+    with file_lock(skeleton + '.lock'):
+        # the spec is written once the skeleton is complete
+        if not exists(skeleton + '.json'):
+            if exists(skeleton):  # from an interrupted attempt
+                rmtree(skeleton)
+            create(skeleton)
+            write_json(skeleton + '.json', spec)
+    return skeleton
+
+
+def venv_from_skeleton(venv_path, skeleton):
+    """Clone the skeleton virtualenv, then point the clone's own paths at itself."""
+    from os.path import abspath
+    print('Cloning a cached virtualenv: {0}'.format(timid_relpath(skeleton)))
+    with file_lock(skeleton + '.lock'):
+        clone_venv(skeleton, venv_path)
+    venv_move_paths(venv_path, abspath(skeleton))
+
+
+def venv_move_paths(venv_path, old_path):
+    """Rewrite the virtualenv's absolute paths, which name old_path, to name venv_path instead."""
+    from os.path import abspath
+    from sys import getfilesystemencoding
+
+    venv_path = abspath(venv_path)
+    old, new = (path.encode(getfilesystemencoding()) for path in (old_path, venv_path))
+    for path, atomically in venv_rewritable_files(venv_path):
+        with open(path, 'rb') as copied:
+            content = copied.read()
+        if old not in content:
+            continue
+        elif atomically:
+            write_atomically(path, content.replace(old, new))
+        else:
+            with open(path, 'wb') as copied:
+                copied.write(content.replace(old, new))
 
 
-def venv_update(stage, venv_path, reqs, venv_args):
+def venv_rewritable_files(venv_path):
+    """Yield (path, atomically) for each file of the virtualenv which may hold its absolute path.
+
+    Only the files clone_venv copies (scripts, activate, and .pth files) can; the rest are hardlinks, so these are
+    rewritten in place. Our own notes (see venv_state_path) name it too; they're always replaced whole, atomically.
+    """
+    from os import walk
+    from os.path import dirname, islink, join
+
+    bindir = join(venv_path, 'bin')
+    statedir = dirname(venv_state_path(venv_path, 'venv.json'))
+    for dirpath, dummy_dirnames, filenames in walk(venv_path):
+        for name in filenames:
+            path = join(dirpath, name)
+            if not islink(path) and (dirpath in (bindir, statedir) or name.endswith(REWRITTEN_IN_PLACE)):
+                yield path, dirpath == statedir
+
+
+@contextmanager
+def venv_transaction(venv_path):
+    """Provide a clone of the virtualenv to be updated, which replaces the original only if there is no error.
+
+    The swap is two renames, not one: between them, for a moment, there's no virtualenv at venv_path at all.
+    """
+    from os import rename, utime
+    from os.path import abspath, basename, dirname, exists, join
+    from shutil import rmtree
+
+    def sibling(suffix):
+        return join(dirname(venv_path), '.{0}.{1}'.format(basename(venv_path), suffix))
+    shadow, old = sibling('shadow'), sibling('old')
+
+    for leftover in (shadow, old):  # from an update that was interrupted
+        if exists(leftover):
+            rmtree(leftover)
+    if exists(venv_path):
+        clone_venv(venv_path, shadow)
+
+    try:
+        yield shadow
+    except BaseException:
+        rmtree(shadow, ignore_errors=True)
+        raise
+
+    if exists(venv_path):
+        rename(venv_path, old)
+    rename(shadow, venv_path)
+    # the shadow may know itself by its own path: a new virtualenv's bin/activate does, as does installed.json
+    venv_move_paths(venv_path, abspath(shadow))
+    utime(venv_path, None)  # so that make knows it's up to date
+    rmtree(old, ignore_errors=True)
+
+
+def venv_update(stage, venv_path, reqs, venv_args, options):
     from os.path import join, abspath
+    if stage == 1 and options.get('transactional'):
+        with venv_transaction(venv_path) as shadow_path:
+            return venv_update(stage, shadow_path, reqs, venv_args, dict(options, transactional=False))
+
     venv_python = abspath(join(venv_path, 'bin', 'python'))
-    if stage == 1:
-        with venv(venv_path, venv_args):
-            stage1(venv_python, reqs, venv_path)
+    if stage == 1 and options.get('single-process'):
+        with phase('virtualenv'):
+            venv_create(venv_path, venv_args, in_process=True, skeleton=options.get('skeleton'))
+        stage1_exec(venv_python, reqs, venv_path, options)
+    elif stage == 1:
+        with phase('stage1'):
+            with venv(venv_path, venv_args, options.get('skeleton')):
+                stage1(venv_python, reqs, venv_path, options)
     elif stage == 2:
-        stage2(venv_python, reqs)
+        with phase('stage2'):
+            exit_code = stage2(venv_python, reqs, options)
+        if options.get('single-process') and not exit_code:
+            # stage1 isn't waiting for us, to finish up
+            venv_postprocess(venv_path, in_process=True)
+            if options.get('last-update'):
+                write_json(venv_state_path(venv_path, 'last-update.json'), options['last-update'])
+        return exit_code
     else:
         raise AssertionError('impossible stage value: %r' % stage)
 
 
-def main():
-    from sys import argv, path
-    del path[:1]  # we don't (want to) import anything from pwd or the script's directory
-    stage, venv_path, reqs, venv_args = parseargs(argv[1:])
+# tox's install options which a requirements file can hold, each with a value (in the same, or the next argument)
+TOX_LINE_OPTIONS = ('-r', '--requirement', '-e', '--editable') + ('-i', '--index-url', '--extra-index-url', '-f', '--find-links')
+
+
+def tox_requirements(args):
+    """Convert tox's install arguments to the lines of a requirements file.
+
+    Returns None if any argument has no equivalent there (--no-deps, for example), since then
+    this isn't simply an install of some requirements.
+    """
+    from os.path import abspath, exists
+
+    lines = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if not arg.startswith('-'):
+            lines.append(arg)
+            continue
+
+        if not arg.startswith('--') and len(arg) > 2:  # eg. -rrequirements.txt
+            option, value = arg[:2], arg[2:]
+        else:
+            option, equals, value = arg.partition('=')
+            if not equals and args:
+                value = args.pop(0)
+        if option not in TOX_LINE_OPTIONS or not value:
+            return None
+
+        # the requirements file we write lives elsewhere, so local paths need to be absolute
+        if option in ('-r', '--requirement') or exists(value):
+            value = abspath(value)
+        lines.append('{0} {1}'.format(option, value))
+    return lines
+
+
+def tox_install(envdir, args, options):
+    """Act as tox's install_command (see --tox). tox has already made the virtualenv."""
+    from os.path import abspath, join
+    from subprocess import CalledProcessError
+
+    envdir_python = abspath(join(envdir, 'bin', 'python'))
+    lines = tox_requirements(args)
+    try:
+        if lines is None:
+            dummy_pip_wheels, cache_opts = pip_cache_options()
+            run((envdir_python, '-m', 'pip.__main__', 'install') + cache_opts + tuple(args))
+        else:
+            run(stage2_command(envdir_python, envdir, (write_requirements(lines),), stage2_options(options)))
+    except CalledProcessError as error:
+        return error.returncode
+    return 0
+
+
+def parse_manifest(manifest):
+    """Read a --batch manifest. Each line holds the arguments for one virtualenv, `#` starts a comment.
+
+    Returns a list of (venv_path, reqs, venv_args).
+    """
+    from shlex import split
+    batch = []
+    with open(manifest) as manifest_file:
+        for line in manifest_file:
+            args = split(line, comments=True)
+            if args:
+                dummy_stage, venv_path, reqs, venv_args = parseargs(args)
+                batch.append((venv_path, reqs, venv_args))
+    return batch
+
+
+def batch_update(manifest, venv_args, options):
+    """Update each of the virtualenvs listed in the manifest.
+
+    All of their wheels are built in a single pass per python, then the virtualenvs are updated in parallel,
+    each by its own venv-update (which takes that virtualenv's lock, as usual), without building anything.
+    """
+    from multiprocessing import cpu_count
+
+    batch = parse_manifest(manifest)
+    if not batch:
+        return 0
+    jobs = int(options.get('jobs') or cpu_count())
+
+    # 1) Caching: one builder virtualenv per python builds the wheels for all of its virtualenvs.
+    for returncode in run_parallel(batch_build_commands(batch, venv_args, options), jobs):
+        if returncode != 0:
+            for venv_path, reqs, dummy_venv_args in batch:
+                mark_venv_invalid(venv_path, reqs)
+            return returncode
+
+    # 2) Install: each virtualenv marks itself invalid, if it fails.
+    exit_code = 0
+    for returncode in run_parallel(batch_update_commands(batch, venv_args, options), jobs):
+        exit_code = exit_code or returncode
+    return exit_code
+
+
+def batch_build_commands(batch, venv_args, options):
+    """A --build-only stage2 command per python, in its builder virtualenv, for all of the batch's requirements."""
+    from os.path import dirname
+    from sys import executable
+
+    reqs_by_python = {}
+    for dummy_venv_path, reqs, batch_venv_args in batch:
+        python = venv_python_option(venv_args + batch_venv_args) or executable
+        python_reqs = reqs_by_python.setdefault(python, [])
+        python_reqs.extend(req for req in reqs if req not in python_reqs)
+
+    build_commands = []
+    for python, python_reqs in sorted(reqs_by_python.items()):
+        builder_python = builder_venv(python)
+        build_commands.append(stage2_command(
+            builder_python, dirname(dirname(builder_python)), python_reqs,
+            ('--build-only',) + stage2_options(options),
+        ))
+    return build_commands
+
+
+def batch_update_commands(batch, venv_args, options):
+    """A venv-update command for each of the batch's virtualenvs, which builds nothing."""
+    from sys import executable
+
+    update_options = dict(
+        (name, value) for name, value in options.items() if name in STAGE2_OPTIONS + ('skeleton',)
+    )
+    update_options['no-build'] = True
+    return [
+        (executable, dotpy(__file__)) + formatopts(update_options) + (venv_path,) + reqs + venv_args + batch_venv_args
+        for venv_path, reqs, batch_venv_args in batch
+    ]
+
+
+def update_or_invalidate(stage, venv_path, reqs, venv_args, options):
+    """Update the virtualenv. If that fails, mark it invalid and return the exit code."""
+    # a --transactional update leaves the original virtualenv as it was (and valid) on failure
+    invalidate = not options.get('transactional')
 
     from subprocess import CalledProcessError
     try:
-        return venv_update(stage, venv_path, reqs, venv_args)
+        return venv_update(stage, venv_path, reqs, venv_args, options)
     except SystemExit as error:
         exit_code = error.code
     except CalledProcessError as error:
@@ -505,14 +3186,106 @@ def main():
     except KeyboardInterrupt:
         exit_code = 1
     except Exception:
-        mark_venv_invalid(venv_path, reqs)
+        if invalidate:
+            mark_venv_invalid(venv_path, reqs)
         raise
 
-    if exit_code != 0:
+    if exit_code != 0 and invalidate:
         mark_venv_invalid(venv_path, reqs)
 
     return exit_code
 
 
+def update_fingerprint(reqs, venv_args):
+    """Two updates with the same fingerprint would produce the same virtualenv."""
+    from json import dumps
+    return sha256hex(dumps([list(venv_args), requirements_fingerprint(reqs)]))
+
+
+def locked_update(venv_path, reqs, venv_args, options):
+    """Update the virtualenv, with no other venv-update working on it at the same time.
+
+    If we had to wait for another update, and it did exactly what we were going to do, we're done.
+    Otherwise we take our turn after it.
+    """
+    from os import unlink
+    from os.path import exists, realpath
+    lock = artifact_lock_path('venv:' + realpath(venv_path))
+
+    # with --single-process, stage2 takes this process (and so, the lock) over, and finishes the update
+    with file_lock(lock, inheritable=options.get('single-process')) as waited:
+        try:
+            fingerprint = update_fingerprint(reqs, venv_args)
+        except IOError:  # a missing requirements file: the update itself will complain
+            fingerprint = None
+
+        last_update = venv_state_path(venv_path, 'last-update.json')
+        if waited and fingerprint is not None and read_json(last_update) == fingerprint:
+            print('A concurrent venv-update just finished the same update of %s' % venv_path)
+            return 0
+
+        # until we succeed, the virtualenv's contents are anyone's guess
+        if exists(last_update):
+            unlink(last_update)
+        if options.get('single-process') and fingerprint is not None:
+            options = dict(options, **{'last-update': fingerprint})
+        exit_code = update_or_invalidate(1, venv_path, reqs, venv_args, options)
+        if not exit_code and fingerprint is not None:
+            write_json(last_update, fingerprint)
+        return exit_code
+
+
+def validate_options(options):
+    """Exit, with a message, if these options don't make sense together."""
+    if options.get('compile', COMPILE_MODES[0]) not in COMPILE_MODES:
+        exit('--compile must be one of: ' + ', '.join(COMPILE_MODES))
+    if options.get('single-process') and ('batch' in options or options.get('transactional')):
+        exit("--single-process can't be combined with --batch or --transactional")
+    if 'batch' in options and options.get('transactional'):
+        exit("--transactional can't be combined with --batch")
+
+
+def main():
+    from sys import argv, path
+    del path[:1]  # we don't (want to) import anything from pwd or the script's directory
+    options, args = parseopts(argv[1:])
+    stage, venv_path, reqs, venv_args = parseargs(args)
+    validate_options(options)
+
+    if 'events' in options:
+        # the stage2 subprocesses inherit this, and so write to the same file
+        from os import environ
+        from os.path import abspath
+        environ[EVENTS_ENVIRON] = abspath(options['events'])
+
+    if 'batch' in options:
+        return batch_update(options['batch'], venv_args, options)
+    if 'tox' in options:
+        return tox_install(options['tox'], args, options)
+    if 'wheel-worker' in options:
+        return wheel_worker(options['wheel-worker'])
+    if options.get('warm-cache'):
+        # there's no virtualenv, so every argument names a requirements file
+        reqs = tuple(arg for arg in args if not arg.startswith('-')) or reqs
+        return warm_cache_for(options.get('interpreters'), reqs, options)
+    return plan_or_update(stage, venv_path, reqs, venv_args, options)
+
+
+def warm_cache_for(interpreters, reqs, options):
+    """--warm-cache, for the --interpreters (comma-separated) if any, otherwise for this one."""
+    if interpreters:
+        return warm_cache_interpreters(reqs, interpreters.split(','), options)
+    return warm_cache(reqs, options)
+
+
+def plan_or_update(stage, venv_path, reqs, venv_args, options):
+    if options.get('plan'):
+        return plan_update(stage, venv_path, reqs, options)
+    elif stage == 1:
+        return locked_update(venv_path, reqs, venv_args, options)
+    else:
+        return update_or_invalidate(stage, venv_path, reqs, venv_args, options)
+
+
 if __name__ == '__main__':
     exit(main())